@@ -5,28 +5,83 @@
 #
 # TODO: Move in to copy subcommand.
 
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
+import mmap
 import os
 
-hashes = {}
-for fn in os.listdir('.'):
-    m = hashlib.sha256()
+# Below this size the cost of setting up a mapping outweighs the copy we save
+MMAP_THRESHOLD = 64 * 1024
+
+
+# We only need a stable content fingerprint, not collision resistance against
+# an adversary, so use the cheaper BLAKE2b with a short digest.
+def hash_file(fp):
+    m = hashlib.blake2b(digest_size=16)
+
+    with open(fp, 'rb', buffering=0) as f:
+        # Hash large files straight out of the page cache. Sequential access
+        # advice lets the kernel drop pages behind us so RSS stays bounded.
+        if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, 'madvise'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+
+                m.update(mm)
+
+            return m.digest()
+
+        # Everything else fits in a single small buffer
+        mv = memoryview(bytearray(MMAP_THRESHOLD))
+        while True:
+            n = f.readinto(mv)
+            if not n:
+                break
+
+            m.update(mv[:n])
 
-    with open(os.path.join('.', fn), 'rb') as f:
-        m.update(f.read())
+    return m.digest()
 
-    prev_fn = hashes.get(m.hexdigest())
+
+def hash_one(fn):
+    return fn, hash_file(os.path.join('.', fn))
+
+
+# Two files can only be duplicates if they have the same size, so group by
+# size first and only hash files whose size collides with another. Hashing
+# happens on a thread pool; hashlib drops the GIL while digesting large
+# buffers.
+filenames = []
+by_size = {}
+with os.scandir('.') as it:
+    for de in it:
+        if not de.is_file():
+            continue
+
+        filenames.append(de.name)
+        by_size.setdefault(de.stat().st_size, []).append(de.name)
+
+sizes = {fn: sz for sz, fns in by_size.items() for fn in fns}
+to_hash = [fn for fns in by_size.values() if len(fns) > 1 for fn in fns]
+
+with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+    digests = dict(executor.map(hash_one, to_hash))
+
+hashes = {}
+for fn in filenames:
+    key = (sizes[fn], digests.get(fn))
+    prev_fn = hashes.get(key)
 
     if prev_fn is None or len(prev_fn) > len(fn):
         if prev_fn is not None:
             print(f'Replacing {prev_fn} with {fn}')
 
-        hashes[m.hexdigest()] = fn
+        hashes[key] = fn
 
-filenames = set(hashes.values())
-for fn in os.listdir('.'):
-    if fn in filenames:
+keep = set(hashes.values())
+for fn in filenames:
+    if fn in keep:
         continue
 
     print(f'Removing {fn}')
-    os.unlink(os.path.join('.', fn))
\ No newline at end of file
+    os.unlink(os.path.join('.', fn))
@@ -1,394 +1,1832 @@
 from argparse import ArgumentParser
+import binascii
+import bisect
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 import email.generator
 import email.message
 import email.parser
 import email.policy
-from flask import Flask, make_response, request
+import functools
+from flask import abort, Flask, Response, request, send_from_directory
 import getpass
 import imaplib
-import io
 import json
 import logging
+import mimetypes
+import mmap
 import os
 import os.path
+import queue
 import re
+import select
 import shutil
+import string
 import sys
+import threading
+import time
+import zlib
 from tempfile import mkstemp
 from urllib.parse import quote_plus, unquote_plus
+from werkzeug.serving import run_simple
+
+# orjson is considerably faster than the stdlib json module, but is optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Used to lock folder indexes against other processes where available
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# A single line of an IMAP LIST response
+_LIST_RE = re.compile(
+    rb'^\((?P<attrs>(\\[a-zA-Z]+\s?)*)\)\s+"(?P<delim>[^"]+)"\s+"(?P<name>[^"]+)"$')
+
+# A run of non-ASCII characters in a modified UTF-7 folder name
+_MUTF7_RE = re.compile(r'&(?P<b64>[A-Za-z0-9+,]*)-')
+
+# The response to STATUS (UIDNEXT UIDVALIDITY)
+_STATUS_RE = re.compile(
+    r'.*\(UIDNEXT (?P<next>\d+) UIDVALIDITY (?P<validity>\d+)\)$')
+
+# The UID in a FETCH response
+_FETCH_UID_RE = re.compile(rb'\bUID (?P<uid>\d+)')
+
+# The matching UIDs in an ESEARCH response
+_ESEARCH_ALL_RE = re.compile(rb'\bALL (?P<set>[\d:,]+)')
+
+# The message size in a FETCH response
+_FETCH_SIZE_RE = re.compile(rb'\bRFC822\.SIZE (?P<size>\d+)')
+
+# Amount of base64 text to decode at a time when writing out attachments
+PAYLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Default number of messages to request in a single UID FETCH
+FETCH_BATCH_SIZE = 16
+
+# Amount of each message to request in a single UID FETCH. imaplib buffers the
+# entire response, so this bounds the memory that a batch takes up.
+FETCH_CHUNK_SIZE = 1024 * 1024
+
+# Amount of data to read from the IMAP server at a time
+IMAP_READ_SIZE = 64 * 1024
+
+# Seconds to IDLE for in fetch --daemon before re-issuing it
+IDLE_TIMEOUT = 9 * 60
+
+# Seconds to wait between attempts to reconnect in fetch --daemon
+RECONNECT_DELAY = 60
+
+# Number of fetched chunks of messages that can be waiting to be written out;
+# see write_messages()
+WRITE_QUEUE_SIZE = 8
+
+# Default number of folders to fetch in parallel
+FETCH_JOBS = 4
+
+# Characters that we can't have in folder names on the local filesystem are
+# replaced with underscores
+_FOLDER_SANITIZE_TABLE = str.maketrans(dict.fromkeys('/[]*', '_'))
+
+# Static parts of the pages rendered by the web UI. Only the dynamic bits are
+# formatted per request.
+_FOLDER_PAGE_HEAD = '''
+<html>
+    <head>
+        <link rel="shortcut icon" href="about:blank">
+        <style type="text/css">
+            .delete {
+                background-color: red;
+            }
+
+            .download {
+                background-color: yellow;
+            }
+
+            .keep {
+                background-color: green;
+            }
+        </style>
+    </head>
+    <body>
+'''
+
+_UID_PAGE_HEAD = string.Template('''
+<html>
+    <head>
+        <link rel="shortcut icon" href="about:blank">
+        <script type="text/javascript">
+            const baseUrl = "$base_url";
+
+            const updateStatus = (status) => {
+                fetch(baseUrl + 'status', {
+                    'method': 'PUT',
+                    'headers': {
+                        'Content-Type': 'application/json',
+                    },
+                    'body': JSON.stringify({
+                        'status': status,
+                    })
+                })
+                .then((r) => {
+                    return r.json();
+                })
+                .then((jo) => {
+                    var div = document.getElementById('statusDiv');
+                    div.classList.remove('delete', 'download', 'keep', 'unknown');
+                    div.classList.add(jo['status']);
+                    div.innerHTML = jo['status'];
+                });
+            };
+
+            const loadSummary = () => {
+                fetch(baseUrl + 'summary')
+                .then((r) => {
+                    return r.json();
+                })
+                .then((jo) => {
+                    document.getElementById('date').textContent = jo['date'];
+                    document.getElementById('from').textContent = jo['from'];
+                    document.getElementById('subject').textContent = jo['subject'];
+                });
+            };
+
+            const loadAttachments = () => {
+                fetch(baseUrl + 'attachments')
+                .then((r) => {
+                    return r.json();
+                })
+                .then((jo) => {
+                    var div = document.getElementById('attachmentsDiv');
+                    for (const att of jo['attachments']) {
+                        var a = document.createElement('a');
+                        a.href = baseUrl + att['path'] + '?disposition=attachment';
+
+                        if (att['inline_image']) {
+                            var img = document.createElement('img');
+                            img.src = baseUrl + att['path'];
+                            img.style.width = '300px';
+                            a.appendChild(img);
+                            a.appendChild(document.createElement('br'));
+                        }
+
+                        a.appendChild(document.createTextNode(att['filename']));
+                        div.appendChild(a);
+                    }
+                });
+            };
+
+            document.addEventListener('DOMContentLoaded', () => {
+                loadSummary();
+                loadAttachments();
+            });
+        </script>
+
+        <style type="text/css">
+            .delete {
+                background-color: red;
+            }
+
+            .download {
+                background-color: yellow;
+            }
+
+            .keep {
+                background-color: green;
+            }
+
+            .unknown {
+                background-color: grey;
+            }
+        </style>
+    </head>
+    <body>
+''')
+
+_PAGE_TAIL = '''
+    </body>
+</html>
+'''
+
+# Sorted UID lists for folder directories, keyed by path, with the mtime of the
+# folder index they were computed from; see list_uids_cached()
+_folder_uids_cache = {}
+
+# Number of metadata files to keep parsed for the web UI; see
+# read_metafile_cached()
+_METAFILE_CACHE_SIZE = 512
+
+# The process umask, which there is no way to read without setting it. Files
+# written by write_file_atomic() get the same permissions as open() would
+# give them, whichever way they are created.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# Folder directories that ensure_dir() has already created in this process.
+# This only ever holds one entry per folder, never per message.
+_ENSURED_DIRS = set()
+
+# Number of recently scanned messages to keep around for the web UI; see
+# scan_message_cached()
+_SCANNED_MESSAGE_CACHE_SIZE = 32
 
 
 # NOTE: The paths here are only interpreted by this program. We do NOT need to
 #       ensure that they are any sort of valid RFC822, IMAP, whatever
 #       construction. Just be self-consistent.
-def get_attachment_parts_and_paths(m, mime_prefix=None):
+def walk_attachments(m):
+    '''
+    Yield (path, part) for each attachment in the given message, in document
+    order, where path is the dotted MIME path of the part.
+    '''
+
+    # Walk the MIME tree depth-first with an explicit stack of (part, path)
+    # pairs, where the path is a tuple of 1-based child indices. Children are
+    # pushed in reverse so that they are visited in document order.
+    stack = [(m, ())]
+    while stack:
+        p, mime_path = stack.pop()
+
+        if p.is_multipart():
+            children = p.get_payload()
+            for i in reversed(range(len(children))):
+                stack.append((children[i], mime_path + (i + 1,)))
+
+            continue
+
+        if p.get_content_disposition() == 'attachment' or p.get_filename():
+            yield '.'.join(map(str, mime_path)) or '1', p
+
+
+def get_attachment_parts_and_paths(m):
+    return dict(walk_attachments(m))
+
+
+def part_is_inline_image(p):
+    '''
+    Should the given part be shown as an inline image?
+    '''
+
+    if p.get_content_maintype() == 'image':
+        return True
+
+    if not p.get_filename():
+        return False
+
+    _, ext = os.path.splitext(p.get_filename())
+
+    if not ext:
+        return False
+
+    ext = ext.lstrip('.').lower()
+    if ext in ['jpg', 'jpeg', 'gif', 'png', 'bmp']:
+        return True
+
+    return False
+
+
+def a2b_base64_lenient(data):
+    '''
+    Decode the given base64, repairing missing or misplaced padding rather
+    than raising, as mail clients are not always careful about it.
+    '''
+
+    try:
+        return binascii.a2b_base64(data)
+    except binascii.Error:
+        pass
+
+    # A lone trailing character can't encode anything, so drop it
+    data = data.replace(b'=', b'')
+    if len(data) % 4 == 1:
+        data = data[:-1]
+
+    return binascii.a2b_base64(data + b'=' * (-len(data) % 4))
+
+
+# Folder names come from a small set, and we map the same ones over and over
+@functools.lru_cache(maxsize=1024)
+def folder_name_path(fn):
+    return os.path.join('.', fn.translate(_FOLDER_SANITIZE_TABLE))
+
+
+def list_uids(folder_path):
+    '''
+    Return a sorted list of the UIDs of messages stored in the given folder
+    directory.
+    '''
+
+    # Message directories are named by their UID. The DirEntry objects from
+    # scandir() know whether they are directories without a stat() call.
+    with os.scandir(folder_path) as it:
+        return sorted(
+            int(de.name) for de in it
+                if de.name.isdigit() and de.is_dir(follow_symlinks=False))
+
+
+def _find_header_end(data, start, end):
+    '''
+    Return the offsets of the end of the header block of the MIME entity in
+    data[start:end], and of the start of its body.
+    '''
+
+    # No headers at all
+    for sep in (b'\r\n', b'\n'):
+        if data[start:start + len(sep)] == sep:
+            return start, start + len(sep)
+
+    best = None
+    for sep in (b'\n\r\n', b'\n\n'):
+        i = data.find(sep, start, end)
+        if i >= 0 and (best is None or i < best[0]):
+            best = (i + 1, i + len(sep))
+
+    return best or (end, end)
+
+
+def _split_multipart(data, start, end, boundary):
+    '''
+    Return a list of (start, end) offsets of the children of the multipart
+    body data[start:end] with the given boundary.
+    '''
+
+    delim_re = re.compile(
+        rb'^--' + re.escape(boundary.encode('utf-8', 'surrogateescape')) +
+            rb'(?P<close>--)?[ \t]*(?:\r?\n|\Z)',
+        re.MULTILINE)
+
+    children = []
+    child_start = None
+    for m in delim_re.finditer(data, start, end):
+        if child_start is not None:
+            # The line break before a delimiter belongs to the delimiter
+            child_end = m.start()
+            if data[child_end - 2:child_end] == b'\r\n':
+                child_end -= 2
+            elif data[child_end - 1:child_end] == b'\n':
+                child_end -= 1
+
+            children.append((child_start, max(child_start, child_end)))
+
+        if m.group('close'):
+            child_start = None
+            break
+
+        child_start = m.end()
+
+    # Missing close delimiter
+    if child_start is not None:
+        children.append((child_start, end))
+
+    return children
+
+
+def scan_attachments(data):
+    '''
+    Find the attachments in the given raw RFC822 message without parsing any
+    part bodies.
+
+    Returns a dict like get_attachment_parts_and_paths(), but whose values are
+    (part, start, end) tuples, where part is a headers-only Message and
+    data[start:end] is its still-encoded body.
+    '''
+
+    hp = email.parser.BytesHeaderParser()
     attachments = {}
 
-    parts = [m]
-    if m.is_multipart():
-        parts = m.get_payload()
+    stack = [(0, len(data), ())]
+    while stack:
+        start, end, mime_path = stack.pop()
+
+        header_end, body_start = _find_header_end(data, start, end)
+        p = hp.parsebytes(data[start:header_end])
+
+        children = []
+        if p.get_content_maintype() == 'multipart' and p.get_boundary():
+            children = _split_multipart(data, body_start, end, p.get_boundary())
+        elif p.get_content_type() == 'message/delivery-status':
+            # Parsed as a list of header blocks, none of them attachments
+            continue
+        elif p.get_content_maintype() == 'message':
+            children = [(body_start, end)]
+
+        if children:
+            for i in reversed(range(len(children))):
+                stack.append(children[i] + (mime_path + (i + 1,),))
+
+            continue
+
+        if p.get_content_disposition() == 'attachment' or p.get_filename():
+            attachments['.'.join(map(str, mime_path)) or '1'] = \
+                (p, body_start, end)
+
+    return attachments
+
+
+def scan_message(fp):
+    '''
+    Return scan_attachments() for the RFC822 message at the given path.
+    '''
+
+    with open(fp, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return scan_attachments(mm)
+
+
+@functools.lru_cache(maxsize=_SCANNED_MESSAGE_CACHE_SIZE)
+def _scan_message(fp, mtime_ns):
+    return scan_message(fp)
+
+
+def scan_message_cached(fp):
+    '''
+    Return scan_attachments() for the RFC822 message at the given path,
+    re-using a recent scan of the same file if it has not changed since.
+    '''
+
+    # The mtime is part of the cache key so that a changed file is re-scanned
+    return _scan_message(fp, os.stat(fp).st_mtime_ns)
+
+
+def _iter_lines(chunks):
+    '''
+    Yield the given chunks of bytes re-cut so that each ends at a line break.
+    '''
+
+    pending = b''
+    for chunk in chunks:
+        pending += chunk
+        n = pending.rfind(b'\n') + 1
+        if n:
+            yield pending[:n]
+            pending = pending[n:]
+
+    if pending:
+        yield pending
+
+
+def _decode_uu(chunks):
+    started = False
+    for chunk in _iter_lines(chunks):
+        out = []
+        for line in chunk.splitlines():
+            if not started:
+                started = line.startswith(b'begin ')
+                continue
+
+            if line.strip() == b'end':
+                yield b''.join(out)
+                return
+
+            if not line:
+                continue
+
+            try:
+                out.append(binascii.a2b_uu(line))
+            except binascii.Error:
+                # Some encoders pad lines with junk; decode just the length
+                # that the line claims, as the email package does
+                nbytes = (((line[0] - 32) & 63) * 4 + 5) // 3
+                out.append(binascii.a2b_uu(line[:nbytes]))
+
+        yield b''.join(out)
+
+
+def decode_payload(cte, chunks):
+    '''
+    Yield the decoded form of a payload in the given Content-Transfer-Encoding
+    that arrives as the given chunks of bytes.
+
+    Like get_payload(decode=True), this makes the best of damaged payloads
+    rather than raising.
+    '''
+
+    if cte == 'base64':
+        # Decode in chunks that are a multiple of 4 characters once whitespace
+        # is dropped
+        pending = b''
+        for chunk in chunks:
+            pending += chunk.translate(None, b' \t\r\n')
+            n = len(pending) - len(pending) % 4
+            if n:
+                yield a2b_base64_lenient(pending[:n])
+                pending = pending[n:]
+
+        if pending:
+            yield a2b_base64_lenient(pending)
+    elif cte == 'quoted-printable':
+        # Soft line breaks never span lines
+        for chunk in _iter_lines(chunks):
+            yield binascii.a2b_qp(chunk)
+    elif cte in ('x-uuencode', 'uuencode', 'uue', 'x-uue'):
+        yield from _decode_uu(chunks)
+    else:
+        yield from chunks
+
+
+def iter_part_payload(fp, p, start, end):
+    '''
+    Yield the decoded payload of a part found by scan_attachments() in the
+    message at the given path, a chunk at a time.
+    '''
+
+    def read_chunks(f, remaining):
+        while remaining:
+            chunk = f.read(min(remaining, PAYLOAD_CHUNK_SIZE))
+            if not chunk:
+                return
+
+            remaining -= len(chunk)
+            yield chunk
+
+    cte = p.get('Content-Transfer-Encoding', '').strip().lower()
+
+    with open(fp, 'rb') as f:
+        f.seek(start)
+        yield from decode_payload(cte, read_chunks(f, end - start))
+
+
+def extract_parts(msg_dir_path):
+    '''
+    Save the decoded attachments of the message in the given directory to
+    files in its parts/ subdirectory, named by MIME path, so that the web UI
+    can serve them as static files.
+
+    A parts/index.json describing the attachments is written last, so its
+    presence means that extraction finished.
+    '''
+
+    message_path = os.path.join(msg_dir_path, 'rfc822')
+    parts_path = os.path.join(msg_dir_path, 'parts')
+
+    # Left over from an interrupted fetch
+    shutil.rmtree(parts_path, ignore_errors=True)
+    os.makedirs(parts_path)
+
+    index = {}
+    for path, (p, start, end) in scan_message(message_path).items():
+        with open(os.path.join(parts_path, path), 'wb') as f:
+            for chunk in iter_part_payload(message_path, p, start, end):
+                f.write(chunk)
+
+        index[path] = {
+            'content_type': p.get_content_type(),
+            'filename': p.get_filename(),
+            'inline_image': part_is_inline_image(p),
+        }
+
+    # This can always be rebuilt from the message, so don't pay to sync it
+    write_metafile(
+        os.path.join(parts_path, 'index.json'), index, durable=False)
+
+
+# imaplib refuses to send commands that it doesn't know about
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+
+class CompressingIMAP4_SSL(imaplib.IMAP4_SSL):
+    '''
+    An IMAP4_SSL connection that can switch to compressing everything it
+    sends and receives with the COMPRESS=DEFLATE extension (RFC 4978).
+
+    Incoming data is buffered here rather than in imaplib's file object so
+    that pending() can tell whether anything has been received but not yet
+    read, which select() on the socket can't.
+    '''
+
+    _compressor = None
+    _decompressor = None
+
+    def __init__(self, *args, **kwargs):
+        self._rbuf = bytearray()
+        super().__init__(*args, **kwargs)
+
+    def compress(self):
+        imap_ok(*self._simple_command('COMPRESS', 'DEFLATE'))
+
+        # Raw deflate streams, without zlib headers
+        self._compressor = zlib.compressobj(-1, zlib.DEFLATED, -15)
+        self._decompressor = zlib.decompressobj(-15)
+
+    def pending(self):
+        '''
+        Return whether any data has been received but not yet read.
+        '''
+
+        return bool(
+            self._rbuf or getattr(self.sock, 'pending', lambda: 0)())
+
+    def _fill(self):
+        data = self.sock.recv(IMAP_READ_SIZE)
+        if not data:
+            return False
+
+        if self._decompressor:
+            data = self._decompressor.decompress(data)
+
+        self._rbuf += data
+        return True
+
+    def read(self, size):
+        while len(self._rbuf) < size and self._fill():
+            pass
+
+        data = bytes(self._rbuf[:size])
+        del self._rbuf[:size]
+
+        return data
+
+    def readline(self):
+        start = 0
+        while True:
+            i = self._rbuf.find(b'\n', start)
+            if i >= 0:
+                break
+
+            if len(self._rbuf) > imaplib._MAXLINE:
+                raise self.error(f'got more than {imaplib._MAXLINE} bytes')
+
+            start = len(self._rbuf)
+            if not self._fill():
+                i = len(self._rbuf) - 1
+                break
+
+        line = bytes(self._rbuf[:i + 1])
+        del self._rbuf[:i + 1]
+
+        return line
+
+    def send(self, data):
+        if not self._compressor:
+            return super().send(data)
+
+        # Literals can be whole messages, so compress them a piece at a time
+        # rather than holding all of the output at once. Flush at the end;
+        # the server needs to see each command.
+        with memoryview(data) as mv:
+            for off in range(0, len(mv), PAYLOAD_CHUNK_SIZE):
+                out = self._compressor.compress(
+                    mv[off:off + PAYLOAD_CHUNK_SIZE])
+                if out:
+                    super().send(out)
+
+        super().send(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+
+
+def imap_connect(args, pw):
+    '''
+    Return a new IMAP connection to the server, logged in.
+    '''
+
+    ic = CompressingIMAP4_SSL(host=args.server)
+    try:
+        if args.verbosity > 2:
+            ic.debug = args.verbosity - 2
+
+        ic.login(args.user, pw)
+
+        # Servers commonly advertise more capabilities once we are logged in
+        # than in the greeting, which is all that imaplib looks at.
+        dat = imap_ok(*ic.capability())
+        ic.capabilities = tuple(dat[-1].decode('ascii').upper().split())
+
+        # Messages are mostly text, even attachments once base64 encoded, so
+        # this pays for itself many times over
+        if has_cap(ic, 'COMPRESS=DEFLATE'):
+            ic.compress()
+    except BaseException:
+        ic.shutdown()
+        raise
+
+    return ic
+
+
+def decode_folder_name(name):
+    '''
+    Decode a folder name as sent by the server, which is in the modified
+    UTF-7 of RFC 3501 section 5.1.3.
+    '''
+
+    def decode(m):
+        b64 = m.group('b64')
+        if not b64:
+            return '&'
+
+        b64 = b64.replace(',', '/') + '=' * (-len(b64) % 4)
+        return binascii.a2b_base64(b64).decode('utf-16-be')
+
+    return _MUTF7_RE.sub(decode, name)
+
+
+def imap_list_folders(ic):
+    '''
+    Yield the name of each folder on the server that can be selected, as sent
+    by the server; see decode_folder_name().
+    '''
+
+    for list_line in imap_ok(*ic.list()):
+        m = _LIST_RE.match(list_line) if isinstance(list_line, bytes) else None
+        if not m:
+            logging.warning(f'skipping LIST response {list_line}')
+            continue
+
+        # Can't select this folder for some reason. Specified by the RFC.
+        if rb'\Noselect' in m.group('attrs').split():
+            continue
+
+        yield m.group('name').decode('ascii')
+
+
+def has_cap(ic, cap):
+    '''
+    Does the server support the given capability?
+    '''
+
+    return cap.upper() in ic.capabilities
+
+
+class IMAPError(RuntimeError):
+    '''
+    An IMAP command failed.
+    '''
+
+
+def imap_ok(typ, data):
+    '''
+    Return the data from an imaplib command response, raising if the command
+    failed.
+
+    This is used instead of assert so that errors are still caught when
+    running with -O.
+    '''
+
+    if typ != 'OK':
+        raise IMAPError(f'IMAP error: {typ} {data}')
+
+    return data
+
+
+def imap_uid_set(uids):
+    '''
+    Return an IMAP sequence set string (e.g. '1:3,7,9:10') covering the given
+    sorted list of UIDs, collapsing contiguous runs into ranges.
+    '''
+
+    runs = []
+    for uid in uids:
+        if runs and runs[-1][1] == uid - 1:
+            runs[-1][1] = uid
+        else:
+            runs.append([uid, uid])
+
+    return ','.join(
+        str(start) if start == end else f'{start}:{end}'
+            for start, end in runs)
+
+
+def parse_uid_set(uid_set):
+    '''
+    Yield each UID in the given IMAP sequence set (e.g. b'1:3,7'); the inverse
+    of imap_uid_set().
+    '''
+
+    for run in uid_set.split(b','):
+        start, _, end = run.partition(b':')
+        start, end = sorted((int(start), int(end or start)))
+        yield from range(start, end + 1)
+
+
+def parse_fetch_response(data):
+    '''
+    Yield (uid, body) for each message in the data returned by imaplib for a
+    UID FETCH of message bodies.
+
+    Each message shows up as a (envelope, body) tuple followed by the bytes
+    closing the envelope. The UID is usually in the part before the body, but
+    servers are free to send it after.
+    '''
+
+    pending = None
+    for item in data:
+        if isinstance(item, tuple):
+            m = _FETCH_UID_RE.search(item[0])
+            if m:
+                yield int(m.group('uid')), item[1]
+                pending = None
+            else:
+                pending = item
+
+            continue
+
+        # There is some kind of failure that will return None; skip it
+        if pending is None or not item:
+            continue
+
+        m = _FETCH_UID_RE.search(item)
+        if m:
+            yield int(m.group('uid')), pending[1]
+
+        pending = None
+
+
+def parse_fetch_sizes(data):
+    '''
+    Yield (uid, size) for each message in the data returned by imaplib for a
+    UID FETCH of RFC822.SIZE.
+    '''
+
+    for item in data:
+        # There is some kind of failure that will return None; skip it
+        if not isinstance(item, bytes):
+            continue
+
+        m = _FETCH_UID_RE.search(item)
+        sm = _FETCH_SIZE_RE.search(item)
+        if m and sm:
+            yield int(m.group('uid')), int(sm.group('size'))
+
+
+def read_message_headers(fp):
+    '''
+    Parse just the headers of the RFC822 message at the given path, without
+    reading the body.
+    '''
+
+    # BytesHeaderParser by itself still reads the entire file, so stop at the
+    # blank line that ends the headers ourselves.
+    lines = []
+    with open(fp, 'rb') as f:
+        for line in f:
+            lines.append(line)
+            if line in (b'\r\n', b'\n'):
+                break
+
+    return email.parser.BytesHeaderParser().parsebytes(b''.join(lines))
+
+
+def json_dumps(obj):
+    '''
+    Serialize the given object to newline-terminated UTF-8 JSON bytes.
+    '''
+
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+
+    return (json.dumps(obj) + '\n').encode('utf-8')
+
+
+def json_loads(data):
+    if orjson:
+        return orjson.loads(data)
+
+    return json.loads(data)
+
+
+def read_metafile(fp):
+    try:
+        with open(fp, 'rb') as f:
+            return json_loads(f.read())
+    except FileNotFoundError:
+        return {}
+
+
+@functools.lru_cache(maxsize=_METAFILE_CACHE_SIZE)
+def _read_metafile(fp, mtime_ns, ino):
+    return read_metafile(fp)
+
+
+def read_metafile_cached(fp):
+    '''
+    Like read_metafile(), but re-use a previous read of the same file if it
+    has not changed since. The result is shared, so don't modify it.
+    '''
+
+    try:
+        st = os.stat(fp)
+    except FileNotFoundError:
+        return {}
+
+    # Metadata files are replaced rather than rewritten, so a new inode number
+    # catches changes that land within the mtime granularity
+    return _read_metafile(fp, st.st_mtime_ns, st.st_ino)
+
+
+@functools.lru_cache(maxsize=16)
+def _list_folder_names(directory, mtime_ns):
+    names = []
+    with os.scandir(directory) as it:
+        for de in it:
+            if not de.is_dir(follow_symlinks=False):
+                continue
+
+            names.append(read_metafile(os.path.join(de.path, 'meta.json'))['NAME'])
+
+    return tuple(sorted(names))
+
+
+def list_folder_names(directory):
+    '''
+    Return the sorted names of the folders in the mail store at the given
+    path, re-using the previous result if no folders have been added or
+    removed since.
+    '''
+
+    return _list_folder_names(directory, os.stat(directory).st_mtime_ns)
+
+
+def write_fully(fd, data):
+    mv = memoryview(data)
+    while mv:
+        mv = mv[os.write(fd, mv):]
+
+
+def write_file_atomic_tmpfile(fp, data, sync=False):
+    '''
+    Atomically replace the file at the given path with the given bytes using
+    an anonymous O_TMPFILE file, which is only given a name once it has been
+    fully written.
+
+    Raises OSError if the platform or filesystem doesn't support this.
+    '''
+
+    dp, fn = os.path.split(fp)
+
+    # Everything is done relative to a descriptor for the directory. Among
+    # other things, this gets os.link() to use linkat(2) with
+    # AT_SYMLINK_FOLLOW, which is needed to link the /proc/self/fd entry.
+    dfd = os.open(dp or '.', os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+    try:
+        fd = os.open(
+            '.', os.O_TMPFILE | os.O_WRONLY | os.O_CLOEXEC, 0o666,
+            dir_fd=dfd)
+        try:
+            write_fully(fd, data)
+            if sync:
+                os.fsync(fd)
+
+            # There is no way to atomically link an O_TMPFILE over an
+            # existing file, so give it a unique temporary name first and
+            # rename that.
+            tmp = f'{fn}.{os.getpid()}.{threading.get_ident()}.tmp'
+            os.link(
+                f'/proc/self/fd/{fd}', tmp,
+                src_dir_fd=dfd, dst_dir_fd=dfd, follow_symlinks=True)
+        finally:
+            os.close(fd)
+
+        try:
+            os.replace(tmp, fn, src_dir_fd=dfd, dst_dir_fd=dfd)
+        except BaseException:
+            os.unlink(tmp, dir_fd=dfd)
+            raise
+
+        if sync:
+            os.fsync(dfd)
+    finally:
+        os.close(dfd)
+
+
+def fsync_dir(dp):
+    dfd = os.open(dp or '.', os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+    try:
+        os.fsync(dfd)
+    finally:
+        os.close(dfd)
+
+
+def write_file_atomic(fp, data, sync=False):
+    '''
+    Atomically replace the file at the given path with the given bytes. If
+    sync is set, don't return until both the file and the rename have made it
+    to disk.
+    '''
+
+    if hasattr(os, 'O_TMPFILE'):
+        try:
+            write_file_atomic_tmpfile(fp, data, sync=sync)
+            return
+        except OSError as e:
+            logging.debug(f'Falling back from O_TMPFILE for {fp}: {e}')
+
+    fn = None
+    try:
+        fd, fn = mkstemp(dir=os.path.dirname(fp))
+        try:
+            # mkstemp() always creates files readable only by us
+            os.fchmod(fd, 0o666 & ~_UMASK)
+            write_fully(fd, data)
+            if sync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        os.replace(fn, fp)
+        fn = None
+
+        if sync:
+            fsync_dir(os.path.dirname(fp))
+    finally:
+        if fn:
+            os.unlink(fn)
+
+
+def ensure_dir(dp):
+    '''
+    Create the given folder directory and any missing parents, skipping the
+    syscalls if we already did so earlier in this process.
+    '''
+
+    if dp in _ENSURED_DIRS:
+        return
+
+    os.makedirs(dp, exist_ok=True)
+    _ENSURED_DIRS.add(dp)
+
+
+def write_metafile(fp, obj, durable=True):
+    '''
+    Write the given object to the metadata file at the given path, whose
+    directory must already exist.
+
+    Durable writes are synced to disk before returning, so they survive a
+    crash. Non-durable writes skip that and the anonymous temporary file dance
+    in write_file_atomic(), and just rename a fixed temporary file into place.
+    This is still atomic, but only safe when nothing else is writing the same
+    file.
+    '''
+
+    if durable:
+        write_file_atomic(fp, json_dumps(obj), sync=True)
+        return
+
+    tmp = fp + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(json_dumps(obj))
+
+    os.replace(tmp, fp)
+
+
+def recover_journal(fp, obj, key):
+    '''
+    Apply the values of the given key left in the journal of the metadata file
+    at the given path by an interrupted MetaWriter; see MetaWriter.
+    '''
+
+    try:
+        with open(fp + '.journal', 'r') as f:
+            values = [int(l) for l in f if l.strip().isdigit()]
+    except FileNotFoundError:
+        return
+
+    # Values only ever increase, and a line torn by a crash can only be
+    # smaller than what was intended
+    if values and max(values) > obj.get(key, 0):
+        logging.debug(f'Recovered {key} {max(values)} from journal of {fp}')
+        obj[key] = max(values)
+
+
+def folder_index_path(folder_path):
+    return os.path.join(folder_path, 'index.json')
+
+
+# Stands in for an flock() on platforms without fcntl
+_FOLDER_INDEX_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def folder_index_locked(folder_path):
+    '''
+    Hold an exclusive lock on the folder's index, so that read-modify-write
+    updates from fetch and the web UI, which may be in different processes,
+    don't lose each other's changes.
+    '''
+
+    if fcntl is None:
+        with _FOLDER_INDEX_LOCK:
+            yield
+
+        return
+
+    # The lock is released when the file is closed
+    with open(folder_index_path(folder_path) + '.lock', 'ab') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def update_folder_index(folder_path, rebuild=False):
+    '''
+    Bring the folder's index.json, a map of UID to message status, in line
+    with the messages on disk and return it.
+
+    The per-message meta.json files remain the source of truth; they are only
+    read for messages that are not in the index yet, or for all of them if
+    rebuild is set.
+    '''
 
-    for i, p in enumerate(parts):
-        if mime_prefix is None:
-            mime_path = str(i + 1)
-        else:
-            mime_path = f'{mime_prefix}.{i + 1}'
+    with folder_index_locked(folder_path):
+        return _update_folder_index(folder_path, rebuild)
 
-        if not p.is_multipart():
-            if p.get_content_disposition() == 'attachment' or \
-                    p.get_filename():
-                attachments[mime_path] = p
 
+def _update_folder_index(folder_path, rebuild):
+    index_path = folder_index_path(folder_path)
+    old_index = {} if rebuild else read_metafile(index_path)
+
+    index = {}
+    for uid in map(str, list_uids(folder_path)):
+        if uid in old_index:
+            index[uid] = old_index[uid]
             continue
 
-        attachments.update(get_attachment_parts_and_paths(p, mime_path))
+        meta_obj = read_metafile(os.path.join(folder_path, uid, 'meta.json'))
+        index[uid] = meta_obj.get('status')
 
-    return attachments
+    if rebuild or index != old_index:
+        write_metafile(index_path, index)
 
+    return index
 
-def part_is_inline_image(p):
+
+def set_folder_index_status(folder_path, uid, status):
     '''
-    Should the given part be shown as an inline image?
+    Record a change to the status of the given message in the folder's index.
     '''
 
-    if p.get_content_maintype() == 'image':
-        return True
-
-    if not p.get_filename():
-        return False
-
-    _, ext = os.path.splitext(p.get_filename())
+    with folder_index_locked(folder_path):
+        index_path = folder_index_path(folder_path)
+        try:
+            with open(index_path, 'rb') as f:
+                index = json_loads(f.read())
+        except FileNotFoundError:
+            # Building the index picks up the new status from meta.json
+            _update_folder_index(folder_path, False)
+            return
 
-    if not ext:
-        return False
+        index[str(uid)] = status
+        write_metafile(index_path, index)
 
-    ext = ext.lstrip('.').lower()
-    if ext in ['jpg', 'jpeg', 'gif', 'png', 'bmp']:
-        return True
 
-    return False
+def read_folder_index(folder_path):
+    '''
+    Return the folder's index, building it first if it does not exist yet.
+    '''
 
+    try:
+        with open(folder_index_path(folder_path), 'rb') as f:
+            return json_loads(f.read())
+    except FileNotFoundError:
+        return update_folder_index(folder_path)
 
-def folder_name_path(fn):
-    return os.path.join('.', re.sub(r'[/\[\]\*]', '_', fn))
 
+def list_uids_cached(folder_path):
+    '''
+    Return a sorted list of the UIDs in the folder's index, re-using the
+    previous result if the index has not changed since.
+    '''
 
-def read_metafile(fp):
+    index_path = folder_index_path(folder_path)
     try:
-        with open(fp, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        mtime = os.stat(index_path).st_mtime_ns
     except FileNotFoundError:
-        return {}
+        update_folder_index(folder_path)
+        mtime = os.stat(index_path).st_mtime_ns
 
+    cached = _folder_uids_cache.get(folder_path)
+    if cached and cached[0] == mtime:
+        return cached[1]
 
-def write_metafile(fp, obj):
-    dp = os.path.dirname(fp)
-    os.makedirs(dp, exist_ok=True)
+    uids = sorted(map(int, read_folder_index(folder_path)))
+    _folder_uids_cache[folder_path] = (mtime, uids)
 
-    fn = None
+    return uids
+
+
+class MetaWriter:
+    '''
+    Batches updates to a metadata file, only writing it out every
+    flush_interval updates or when explicitly flushed.
+
+    Updates to journal_key are also appended to a journal file next to the
+    metadata file as they are made, which is much cheaper than rewriting the
+    whole file. If we are interrupted between flushes, recover_journal() picks
+    up where we left off.
+    '''
+
+    def __init__(self, fp, obj, flush_interval=64, journal_key=None):
+        self.fp = fp
+        self.obj = obj
+        self.flush_interval = flush_interval
+        self.journal_key = journal_key
+        self.journal = None
+        self.dirty_count = 0
+
+    def update(self, key, value):
+        self.obj[key] = value
+        self.dirty_count += 1
+
+        if key == self.journal_key:
+            if self.journal is None:
+                self.journal = open(self.fp + '.journal', 'a', buffering=1)
+
+            self.journal.write(f'{value}\n')
+
+        # Intermediate flushes are just checkpoints; the journal covers us
+        if self.dirty_count >= self.flush_interval:
+            self.flush(durable=False)
+
+    def flush(self, durable=True):
+        if not self.dirty_count:
+            return
+
+        write_metafile(self.fp, self.obj, durable=durable)
+        self.dirty_count = 0
+
+        # Everything in the journal is in the metadata file now
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+            os.unlink(self.fp + '.journal')
+
+
+def fetch_connect(args, pw):
+    '''
+    Return a new IMAP connection for fetching.
+    '''
+
+    ic = imap_connect(args, pw)
+
+    # Have the server report HIGHESTMODSEQ so that we can skip unchanged
+    # folders in fetch_folder()
+    if has_cap(ic, 'CONDSTORE') and has_cap(ic, 'ENABLE') and \
+            hasattr(ic, 'enable'):
+        ic.enable('CONDSTORE')
+
+    return ic
+
+
+def write_messages(folder_path, mw, messages):
+    '''
+    Write the (uid, chunk, done) tuples from the given queue to the given
+    folder directory until None is received, advancing UIDFETCHNEXT in the
+    given MetaWriter as we go.
+
+    Each message arrives as a series of chunks, the last of which has done
+    set. A chunk of None means that the message went away part way through
+    and what we have of it should be thrown out. The first chunk of each
+    message must arrive in UID order, but the rest may be interleaved.
+
+    This runs on its own thread, and is the only thing touching the
+    MetaWriter until it returns.
+    '''
+
+    files = {}
+    done_uid = None
     try:
-        fd, fn = mkstemp(dir=dp)
-        os.close(fd)
+        for uid, chunk, done in iter(messages.get, None):
+            # The folder directory is known to exist. The message directory
+            # may too if we were interrupted before UIDFETCHNEXT was flushed.
+            msg_dir_path = os.path.join(folder_path, str(uid))
+            msg_path = os.path.join(msg_dir_path, 'rfc822')
+
+            f = files.get(uid)
+            if f is None:
+                try:
+                    os.mkdir(msg_dir_path)
+                except FileExistsError:
+                    pass
+
+                f = files[uid] = open(msg_path + '.tmp', 'wb')
+
+            if chunk is None:
+                del files[uid]
+                f.close()
+                os.unlink(msg_path + '.tmp')
+                continue
 
-        with open(fn, 'w', encoding='utf-8') as f:
-            json.dump(obj, f)
-            f.write('\n')
+            f.write(chunk)
+            if not done:
+                continue
 
-        os.rename(fn, fp)
-        fn = None
+            # The message only shows up under its real name once it has been
+            # fully written, so an interrupted fetch never leaves a truncated
+            # one behind
+            del files[uid]
+            f.close()
+            os.replace(msg_path + '.tmp', msg_path)
+
+            # Pay for decoding attachments once here rather than every time
+            # they are viewed. The web UI falls back to working from the
+            # message itself without a parts index, so a message that we
+            # can't make sense of shouldn't stop the fetch.
+            try:
+                extract_parts(msg_dir_path)
+            except Exception as e:
+                logging.warning(
+                    f'Unable to extract attachments from {msg_dir_path}: {e}')
+
+            # Everything below the lowest message still being written is on
+            # disk
+            done_uid = max(uid, done_uid or uid)
+            mw.update('UIDFETCHNEXT', min(files, default=done_uid + 1))
+    except BaseException:
+        # Keep draining the queue so that the fetching side never blocks on
+        # it; it notices that we are done after its current batch
+        for _ in iter(messages.get, None):
+            pass
+
+        raise
     finally:
-        if fn:
-            os.unlink(fn)
+        for f in files.values():
+            f.close()
 
 
-def fetch(args):
-    if args.p:
-        with open(args.p, 'r') as pf:
-            pw = pf.read().strip()
+def fetch_folder(ic, args, folder_name):
+    '''
+    Fetch new messages in the given folder using the given connection.
+    '''
+
+    decoded_name = decode_folder_name(folder_name)
+    logging.info(f'Fetching messages for folder {decoded_name}')
+
+    folder_path = os.path.join(args.directory, folder_name_path(decoded_name))
+    folder_meta_path = os.path.join(folder_path, 'meta.json')
+    meta_obj = read_metafile(folder_meta_path)
+    recover_journal(folder_meta_path, meta_obj, 'UIDFETCHNEXT')
+
+    # Manually quote the folder name. The imaplib cllient doesn't do
+    # this by itself, for some reason. Whatever.
+    imap_ok(*ic.select(f'"{folder_name}"', readonly=True))
+
+    # Selecting the folder reports UIDNEXT and UIDVALIDITY, so we only need
+    # STATUS for servers that leave them out
+    _, uidnext = ic.response('UIDNEXT')
+    _, uidvalidity = ic.response('UIDVALIDITY')
+    if uidnext[0] and uidvalidity[0]:
+        uidnext = int(uidnext[0])
+        uidvalidity = int(uidvalidity[0])
     else:
-        pw = getpass.getpass(prompt=f'Password for {args.user}: ')
+        folder_status = imap_ok(*ic.status(f'"{folder_name}"', '(UIDNEXT UIDVALIDITY)'))
+        folder_status = folder_status[0].decode('utf-8')
+        m = _STATUS_RE.match(folder_status)
+        uidnext = int(m.groupdict()['next'])
+        uidvalidity = int(m.groupdict()['validity'])
+
+    # Handling UIDVALIDITY changes is way outside the scope of this
+    # tool, and should be very rare anyway, as this indicates the
+    # server's state has been corrupted.
+    if meta_obj.get('UIDVALIDITY') != uidvalidity and \
+            os.path.exists(folder_path):
+        raise RuntimeError(
+            f'UIDVALIDITY changed on existing mail directory {folder_path}!')
+
+    meta_obj['UIDVALIDITY'] = uidvalidity
+
+    ensure_dir(folder_path)
+
+    if 'NAME' not in meta_obj:
+        meta_obj['NAME'] = decoded_name
+        write_metafile(folder_meta_path, meta_obj)
+
+    # If the server supports CONDSTORE and nothing in the folder has
+    # changed since our last complete pass, there is nothing to do.
+    # Note that this relies on expunges bumping HIGHESTMODSEQ, which
+    # in practice they do as messages are flagged \Deleted first.
+    _, modseq = ic.response('HIGHESTMODSEQ')
+    modseq = int(modseq[0]) if modseq and modseq[0] else None
+    if modseq is not None and \
+            meta_obj.get('HIGHESTMODSEQ') == modseq and \
+            meta_obj.get('UIDFETCHNEXT') == uidnext:
+        logging.debug(f'Skipping unchanged folder {decoded_name}')
+        ic.unselect()
+        return
+
+    # Find messages >1MB in size. Servers with ESEARCH can return them as a
+    # sequence set, which is much smaller than a list of every UID.
+    if has_cap(ic, 'ESEARCH'):
+        imap_ok(*ic.uid(
+            'search', 'RETURN', '(ALL)', 'UID', '1:*', 'LARGER', str(1024 * 1024)))
+        _, data = ic.response('ESEARCH')
+        m = _ESEARCH_ALL_RE.search(data[-1] or b'')
+        uids = list(parse_uid_set(m.group('set'))) if m else []
+    else:
+        uids = imap_ok(*ic.uid('search', 'UID', f'1:*', 'LARGER', str(1024 * 1024)))
+        uids = uids[0].decode('utf-8')
 
-    with imaplib.IMAP4_SSL(host=args.server) as ic:
-        if args.verbosity > 2:
-            ic.debug = args.verbosity - 2
+        # We may get an empty string back; be careful and ensure that we
+        # always end up with a uids[] array even if it's empty
+        if uids:
+            uids = [int(u) for u in uids.split(' ')]
+        else:
+            uids = []
 
-        ic.login(args.user, pw)
+    # Iterate over our local UIDs and cull any that no longer exist on
+    # the server
+    server_uids = set(uids)
+    for luid in list_uids(folder_path):
+        if luid in server_uids:
+            continue
 
-        # Walk list of server folders
-        typ, list_lines = ic.list()
-        assert typ == 'OK'
-        for list_line in map(lambda l: l.decode('utf-8'), list_lines):
-            m = re.match(r'^\((?P<attrs>(\\[a-zA-Z]+\s?)*)\)\s+"(?P<delim>[^"]+)"\s+"(?P<name>[^"]+)"$', list_line)
-            if not m:
-                logging.warning(f'skipping LIST response {f}')
-                continue
+        logging.debug(f'Deleting stale local UID {luid}')
+        shutil.rmtree(os.path.join(folder_path, str(luid)))
 
-            gd = m.groupdict()
+    # Fetch new messages in batches, one UID FETCH per batch rather
+    # than per message. Messages are written out on another thread so that
+    # disk I/O overlaps with fetching the next batch. UIDFETCHNEXT is
+    # advanced and journalled as each message is written, but the metadata
+    # file itself is only rewritten periodically.
+    mw = MetaWriter(
+        folder_meta_path, meta_obj, journal_key='UIDFETCHNEXT')
+    try:
+        messages = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            writer = executor.submit(write_messages, folder_path, mw, messages)
+            try:
+                new_uids = [u for u in uids if u >= meta_obj.get('UIDFETCHNEXT', 0)]
+                for index in range(0, len(new_uids), args.pipeline):
+                    # The writer failed; its exception is raised below
+                    if writer.done():
+                        break
 
-            folder_name = gd['name']
-            folder_attrs = set(re.split(r'\s+', gd['attrs']))
+                    batch = new_uids[index:index + args.pipeline]
+                    logging.debug(
+                        f'Fetching messages {index + 1}-{index + len(batch)}/{len(new_uids)}')
+
+                    # Messages that disappeared since the SEARCH are just
+                    # missing from the response
+                    data = imap_ok(*ic.uid('fetch', imap_uid_set(batch), '(UID RFC822.SIZE)'))
+                    sizes = dict(parse_fetch_sizes(data))
+
+                    # Fetch the batch a chunk of each message at a time rather
+                    # than whole messages, which can be huge. BODY.PEEK[]
+                    # rather than RFC822 so that we never set the \Seen flag,
+                    # even if the folder is not read-only.
+                    offset = 0
+                    while sizes:
+                        data = imap_ok(*ic.uid(
+                            'fetch', imap_uid_set(sorted(sizes)),
+                            f'(UID BODY.PEEK[]<{offset}.{FETCH_CHUNK_SIZE}>)'))
+                        chunks = dict(parse_fetch_response(data))
+
+                        # Hand chunks to the writer in UID order; see
+                        # write_messages()
+                        for uid in sorted(sizes):
+                            chunk = chunks.get(uid)
+                            done = chunk is None or \
+                                len(chunk) < FETCH_CHUNK_SIZE or \
+                                offset + len(chunk) >= sizes[uid]
+                            if done:
+                                del sizes[uid]
+
+                            if chunk is None and not offset:
+                                continue
+
+                            messages.put((uid, chunk, done))
+
+                        offset += FETCH_CHUNK_SIZE
+            finally:
+                messages.put(None)
+
+            writer.result()
+
+        # If we made it all the way through our list of messages, use
+        # UIDNEXT since we know that nothing else matches.
+        mw.update('UIDFETCHNEXT', uidnext)
+
+        if modseq is not None:
+            mw.update('HIGHESTMODSEQ', modseq)
+    finally:
+        mw.flush()
 
-            # Can't select this folder for some reason. Specified by the RFC.
-            if r'\Noselect' in folder_attrs:
-                continue
+        # Pick up messages written and culled above
+        update_folder_index(folder_path)
 
-            logging.info(f'Fetching messages for folder {folder_name}')
+    ic.unselect()
 
-            folder_path = os.path.join(args.directory, folder_name_path(folder_name))
-            folder_meta_path = os.path.join(folder_path, 'meta.json')
-            meta_obj = read_metafile(folder_meta_path)
 
-            # Fetch UIDNEXT, UIDVALIDITY
-            typ, folder_status = ic.status(f'"{folder_name}"', '(UIDNEXT UIDVALIDITY)')
-            folder_status = folder_status[0].decode('utf-8')
-            assert typ == 'OK'
-            m = re.match(r'.*\(UIDNEXT (?P<next>\d+) UIDVALIDITY (?P<validity>\d+)\)$', folder_status)
-            uidnext = int(m.groupdict()['next'])
-            uidvalidity = int(m.groupdict()['validity'])
+def fetch_folders(ic, args, folder_names):
+    '''
+    Fetch folders from the given queue of names using the given connection
+    until the queue is empty.
+    '''
 
-            # Handling UIDVALIDITY changes is way outside the scope of this
-            # tool, and should be very rare anyway, as this indicates the
-            # server's state has been corrupted.
-            assert meta_obj.get('UIDVALIDITY') == uidvalidity or \
-                    not os.path.exists(folder_path), \
-                'UIDVALIDITY changed on existing mail directory!'
+    while True:
+        try:
+            folder_name = folder_names.get_nowait()
+        except queue.Empty:
+            return
 
-            meta_obj['UIDVALIDITY'] = uidvalidity
+        fetch_folder(ic, args, folder_name)
 
-            if 'NAME' not in meta_obj:
-                meta_obj['NAME'] = folder_name
-                write_metafile(folder_meta_path, meta_obj)
 
-            # Manually quote the folder name. The imaplib cllient doesn't do
-            # this by itself, for some reason. Whatever.
-            typ, _ = ic.select(f'"{folder_name}"', readonly=True)
-            assert typ =='OK'
-
-            # Find messages >1MB in size.
-            typ, uids = ic.uid('search', 'UID', f'1:*', 'LARGER', str(1024 * 1024))
-            assert typ == 'OK'
-            uids = uids[0].decode('utf-8')
-
-            # We may get an empty string back; be careful and ensure that we always end up
-            # with a uids[] array even if it's empty
-            if uids:
-                uids = [int(u) for u in uids.split(' ')]
-            else:
-                uids = []
-
-            # Iterate over our local UIDs and cull any that no longer exist on
-            # the server
-            for luid in sorted([
-                    int(fn) for fn in os.listdir(folder_path)
-                        if re.match(r'^\d+$', fn)]):
-                if luid in uids:
-                    continue
+def fetch_worker(args, pw, folder_names):
+    with fetch_connect(args, pw) as ic:
+        fetch_folders(ic, args, folder_names)
 
-                logging.debug(f'Deleting stale local UID {luid}')
-                shutil.rmtree(os.path.join(folder_path, str(luid)))
 
-            # Fetch all of the messages and keep UIDFETCHNEXT up to date
-            for index, uid in enumerate([u for u in uids if u > meta_obj.get('UIDFETCHNEXT', 0)]):
-                logging.debug(f'Fetching message {index + 1}/{len(uids)}')
+def fetch_reconnect(args, pw):
+    '''
+    Return a new IMAP connection for fetching, retrying for as long as the
+    server can't be reached.
+    '''
 
-                typ, data = ic.uid('fetch', str(uid), '(RFC822)')
-                assert typ == 'OK'
+    while True:
+        try:
+            return fetch_connect(args, pw)
+        except (OSError, imaplib.IMAP4.abort) as e:
+            logging.warning(f'Unable to connect to the server: {e}')
+            time.sleep(RECONNECT_DELAY)
 
-                meta_obj['UIDFETCHNEXT'] = uid + 1
-                write_metafile(folder_meta_path, meta_obj)
 
-                # There is some kind of failure that will return [None]; skip it
-                if not data[0]:
-                    continue
+def fetch_all(ic, args, pw, jobs):
+    '''
+    Fetch new messages in all folders, using the given connection and up to
+    jobs - 1 others of our own.
+    '''
 
-                msg_dir_path = os.path.join(folder_path, str(uid))
-                assert not os.path.isdir(msg_dir_path)
-                os.makedirs(msg_dir_path)
+    folder_names = queue.Queue()
+    for folder_name in imap_list_folders(ic):
+        folder_names.put(folder_name)
 
-                with open(os.path.join(msg_dir_path, 'rfc822'), 'wb') as f:
-                    f.write(data[0][1])
+    # Folders are independent, so fetch several at once, each over its
+    # own connection. This connection does its share too.
+    jobs = max(min(jobs, folder_names.qsize()), 1)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(fetch_worker, args, pw, folder_names)
+                for _ in range(jobs - 1)]
 
-            # If we made it all the way through our list of messages, use
-            # UIDNEXT since we know that nothing else matches.
-            meta_obj['UIDFETCHNEXT'] = uidnext
-            write_metafile(folder_meta_path, meta_obj)
+        fetch_folders(ic, args, folder_names)
 
-            ic.unselect()
+        for future in futures:
+            future.result()
 
 
-def web(args):
-    app = Flask('harvest')
+def imap_idle(ic, timeout):
+    '''
+    Wait with IDLE for the server to report a change to the selected folder,
+    giving up after the given number of seconds. Returns whether anything
+    changed.
 
-    @app.route("/")
-    def root():
-        folders = []
+    imaplib has no support for IDLE, so speak the protocol ourselves.
+    '''
 
-        for fn in os.listdir(args.directory):
-            if not os.path.isdir(os.path.join(args.directory, fn)):
-                continue
+    tag = ic._new_tag()
+    ic.tagged_commands.pop(tag, None)
 
-            meta_obj = read_metafile(os.path.join(args.directory, fn, 'meta.json'))
+    # Any untagged response while idling means that something happened. The
+    # server may send some before it agrees to idle, too.
+    ic.send(tag + b' IDLE\r\n')
+    changed = False
+    while True:
+        line = ic.readline()
+        if not line:
+            raise ic.abort('socket error: EOF')
 
-            folders += [meta_obj['NAME']]
+        if line.startswith(b'+'):
+            break
 
-        out = '<ul>\n';
-        for fn in sorted(folders):
-            out += f'  <li><a href="/{quote_plus(fn)}">{fn}</a></li>'
-        out += '</ul>'
+        if not line.startswith(b'* '):
+            raise IMAPError(f'IMAP error: IDLE {line}')
 
-        return out
+        changed = True
 
-    @app.route("/<path:folder>/")
-    def folder(folder):
-        folder = unquote_plus(folder)
-        fp = os.path.join(args.directory, folder_name_path(folder))
+    # The connection buffers what it reads, so check that before waiting on
+    # the socket
+    if not changed:
+        changed = bool(
+            ic.pending() or select.select([ic.socket()], [], [], timeout)[0])
 
-        uids = []
-        for fn in os.listdir(fp):
-            if not os.path.isdir(os.path.join(fp, fn)):
-                continue
+    ic.send(b'DONE\r\n')
+    while True:
+        line = ic.readline()
+        if not line:
+            raise ic.abort('socket error: EOF')
 
-            meta_obj = read_metafile(os.path.join(fp, fn, 'meta.json'))
-            status = meta_obj.get('status', 'unknown')
+        if not line.startswith(tag + b' '):
+            changed = True
+            continue
 
-            uids += [(int(fn), status)]
+        if not line.startswith(tag + b' OK'):
+            raise IMAPError(f'IMAP error: IDLE {line}')
 
-        out = '''
-<html>
-    <head>
-        <link rel="shortcut icon" href="about:blank">
-        <style type="text/css">
-            .delete {
-                background-color: red;
-            }
+        return changed
 
-            .download {
-                background-color: yellow;
-            }
 
-            .keep {
-                background-color: green;
-            }
-        </style>
-    </head>
-    <body>
-'''
+def fetch_changes(ic, args, pw, catch_up=False):
+    '''
+    Fetch new messages over the given connection whenever something changes
+    in the INBOX, which is where new mail turns up, until the connection
+    drops. If catch_up is set, fetch once before waiting.
 
-        out += '<ul>'
-        for uid, status in sorted(uids):
-            out += f'  <li><a href="/{folder}/{uid}" class="{status}">{uid}</a></li>'
-        out += '</ul>'
+    Unchanged folders are skipped, so this makes do with the one connection
+    rather than logging in again each time.
+    '''
 
-        out += '''
-    </body>
-</html>
-'''
+    try:
+        if catch_up:
+            fetch_all(ic, args, pw, 1)
+
+        while True:
+            # Servers drop idle clients after 30 minutes, so IDLE is
+            # re-issued more often than that
+            if has_cap(ic, 'IDLE'):
+                imap_ok(*ic.select('INBOX', readonly=True))
+                while not imap_idle(ic, IDLE_TIMEOUT):
+                    pass
+
+                ic.unselect()
+            else:
+                time.sleep(IDLE_TIMEOUT)
 
-        return out
+            logging.info('Fetching changes')
+            fetch_all(ic, args, pw, 1)
+    except imaplib.IMAP4.abort as e:
+        logging.warning(f'Lost connection to the server: {e}')
 
-    @app.route("/<path:folder>/<int:uid>")
-    def uid(folder, uid):
+        # There is no logging out of a dead connection
+        ic.state = 'LOGOUT'
+        try:
+            ic.shutdown()
+        except OSError:
+            pass
+
+
+def fetch(args):
+    if args.p:
+        with open(args.p, 'r') as pf:
+            pw = pf.read().strip()
+    else:
+        pw = getpass.getpass(prompt=f'Password for {args.user}: ')
+
+    with fetch_connect(args, pw) as ic:
+        fetch_all(ic, args, pw, args.jobs)
+
+        if args.daemon:
+            fetch_changes(ic, args, pw)
+
+    # Everything fetched before the connection dropped is on disk, so just
+    # catch up from there
+    while args.daemon:
+        with fetch_reconnect(args, pw) as ic:
+            fetch_changes(ic, args, pw, catch_up=True)
+
+
+def web(args):
+    app = Flask('harvest')
+    store_path = os.path.realpath(args.directory)
+
+    def folder_dir(folder):
+        '''
+        Return the local directory for the given folder name from a URL,
+        refusing names like '..' that would escape the mail store.
+        '''
+
+        fp = os.path.realpath(os.path.join(store_path, folder_name_path(folder)))
+        if os.path.dirname(fp) != store_path:
+            abort(404)
+
+        return fp
+
+    @app.route("/", methods=['GET'])
+    def root():
+        out = ['<ul>\n']
+        out.extend(
+            f'  <li><a href="/{quote_plus(fn)}">{fn}</a></li>'
+                for fn in list_folder_names(args.directory))
+        out.append('</ul>')
+
+        return ''.join(out)
+
+    @app.route("/<path:folder>/", methods=['GET'])
+    def folder(folder):
         folder = unquote_plus(folder)
+        fp = folder_dir(folder)
+        q_folder = quote_plus(folder)
 
-        fp = os.path.join(args.directory, folder_name_path(folder))
+        index = read_metafile_cached(folder_index_path(fp)) or \
+            read_folder_index(fp)
+        uids = [
+            (int(uid), status or 'unknown') for uid, status in index.items()]
+
+        out = [_FOLDER_PAGE_HEAD]
+
+        out.append('<ul>')
+        out.extend(
+            f'  <li><a href="/{q_folder}/{uid}" class="{status}">{uid}</a></li>'
+                for uid, status in sorted(uids))
+        out.append('</ul>')
+
+        out.append(_PAGE_TAIL)
+
+        return ''.join(out)
+
+    @app.route("/<path:folder>/<int:uid>", methods=['GET'])
+    def uid(folder, uid):
+        folder = unquote_plus(folder)
+        fp = folder_dir(folder)
+        q_folder = quote_plus(folder)
 
         # Get the metadata
         up = os.path.join(fp, str(uid))
-        meta_obj = read_metafile(os.path.join(up, 'meta.json'))
-
-        # Parse the message
-        bp = email.parser.BytesParser()
-        with open(os.path.join(up, 'rfc822'), 'rb') as f:
-            m = bp.parse(f)
+        meta_obj = read_metafile_cached(os.path.join(up, 'meta.json'))
 
         # Compute the prev / next UIDs
-        uids = sorted([int(fn) for fn in os.listdir(fp) if re.match(r'^\d+$', fn)])
-        uid_idx = uids.index(uid)
+        uids = list_uids_cached(fp)
+        uid_idx = bisect.bisect_left(uids, uid)
+        if uid_idx == len(uids) or uids[uid_idx] != uid:
+            abort(404)
+
+        # The message itself is not parsed here. This page is just a skeleton
+        # and the script fills in the headers and attachments from the
+        # summary and attachments routes.
+        out = [_UID_PAGE_HEAD.substitute(base_url=f'/{q_folder}/{uid}/')]
+        status = meta_obj.get('status', 'unknown')
+        out.append(f'<div id="statusDiv" class="{status}">{status}</div>')
 
-        out = f'''
-<html>
-    <head>
-        <link rel="shortcut icon" href="about:blank">
-        <script type="text/javascript">
-            const updateStatus = (status) => {{
-                const url ="/{folder}/{uid}/status";
-                var p = fetch(url, {{
-                    'method': 'PUT',
-                    'headers': {{
-                        'Content-Type': 'application/json',
-                    }},
-                    'body': JSON.stringify({{
-                        'status': status,
-                    }})
-                }})
-                .then((r) => {{
-                    return r.json();
-                }})
-                .then((jo) => {{
-                    var div = document.getElementById('statusDiv');
-                    div.classList.remove('delete', 'download', 'keep', 'unknown');
-                    div.classList.add(jo['status']);
-                    div.innerHTML = jo['status'];
-                }});
-            }};
-        </script>
+        out.append('Date: <span id="date"></span><br/>')
+        out.append('From: <tt id="from"></tt><br/>')
+        out.append('Subject: <span id="subject"></span><br/>')
 
-        <style type="text/css">
-            .delete {{
-                background-color: red;
-            }}
+        out.append(f'<a href="/{q_folder}/{uids[uid_idx - 1]}">Prev</a>')
+        out.append(f'<button onclick="updateStatus(\'delete\');" class="delete">Delete</button>')
+        out.append(f'<button onclick="updateStatus(\'download\');" class="download">Download</button>')
+        out.append(f'<button onclick="updateStatus(\'keep\');" class="keep">Keep</button>')
+        out.append(f'<a href="/{q_folder}/{uids[0 if uid_idx == len(uids) - 1 else uid_idx + 1]}">Next</a>')
 
-            .download {{
-                background-color: yellow;
-            }}
+        out.append('<div id="attachmentsDiv" style="display: flex; flex-wrap: wrap;"></div>')
 
-            .keep {{
-                background-color: green;
-            }}
+        out.append(_PAGE_TAIL)
+        return ''.join(out)
 
-            .unknown {{
-                background-color: grey;
-            }}
-        </style>
-    </head>
-    <body>
-'''
-        status = meta_obj.get('status', 'unknown')
-        out += f'<div id="statusDiv" class="{status}">{status}</div>'
-
-        out += f'Date: {m["Date"]}<br/>'
-        out += f'From: <tt>{m["From"]}</tt><br/>'
-        out += f'Subject: {m["Subject"]}<br/>'
-
-        out += f'<a href="/{folder}/{uids[uid_idx - 1]}">Prev</a>'
-        out += f'<button onclick="updateStatus(\'delete\');" class="delete">Delete</button>'
-        out += f'<button onclick="updateStatus(\'download\');" class="download">Download</button>'
-        out += f'<button onclick="updateStatus(\'keep\');" class="keep">Keep</button>'
-        out += f'<a href="/{folder}/{uids[0 if uid_idx == len(uids) - 1 else uid_idx + 1]}">Next</a>'
-
-        out += '<div style="display: flex; flex-wrap: wrap;">'
-        for path, p in get_attachment_parts_and_paths(m).items():
-            if part_is_inline_image(p):
-                out += f'<a href="/{quote_plus(folder)}/{uid}/{path}?disposition=attachment"><img src="/{quote_plus(folder)}/{uid}/{path}" style="width: 300px;"/><br/>{p.get_filename()}</a>'
-            else:
-                out += f'<a href="/{quote_plus(folder)}/{uid}/{path}?disposition=attachment">{p.get_filename()}</a>'
-        out += '</div>'
+    @app.route("/<path:folder>/<int:uid>/summary", methods=['GET'])
+    def summary(folder, uid):
+        folder = unquote_plus(folder)
 
-        out += '''
-    </body>
-</html>
-'''
-        return out
+        up = os.path.join(folder_dir(folder), str(uid))
+        if not os.path.isdir(up):
+            abort(404)
+
+        m = read_message_headers(os.path.join(up, 'rfc822'))
+
+        # Headers with raw 8-bit data come back as Header objects rather than
+        # strings
+        return {
+            'date': str(m.get('Date', '')),
+            'from': str(m.get('From', '')),
+            'subject': str(m.get('Subject', '')),
+        }
+
+    @app.route("/<path:folder>/<int:uid>/attachments", methods=['GET'])
+    def attachments(folder, uid):
+        folder = unquote_plus(folder)
+
+        up = os.path.join(folder_dir(folder), str(uid))
+        if not os.path.isdir(up):
+            abort(404)
+
+        # Messages fetched before attachments were extracted have no parts
+        # index, but only the MIME structure is needed here anyway. An empty
+        # index just means that there are no attachments.
+        index_path = os.path.join(up, 'parts', 'index.json')
+        if os.path.exists(index_path):
+            parts = read_metafile(index_path)
+        else:
+            scanned = scan_message_cached(os.path.join(up, 'rfc822'))
+            parts = {
+                path: {
+                    'filename': p.get_filename(),
+                    'inline_image': part_is_inline_image(p),
+                }
+                for path, (p, _, _) in scanned.items()
+            }
+
+        return {
+            'attachments': [
+                {
+                    'path': path,
+                    'filename': part['filename'],
+                    'inline_image': part['inline_image'],
+                }
+                for path, part in parts.items()
+            ],
+        }
 
     @app.route("/<path:folder>/<int:uid>/status", methods=['PUT'])
     def status(folder, uid):
         folder = unquote_plus(folder)
-
-        fp = os.path.join(args.directory, folder_name_path(folder))
+        fp = folder_dir(folder)
 
         # Get the metadata
-        mp = os.path.join(fp, str(uid), 'meta.json')
+        up = os.path.join(fp, str(uid))
+        if not os.path.isdir(up):
+            abort(404)
+
+        mp = os.path.join(up, 'meta.json')
         meta_obj = read_metafile(mp)
 
         request_json = request.get_json()
@@ -396,32 +1834,113 @@ def web(args):
             meta_obj['status'] = request_json['status']
             write_metafile(mp, meta_obj)
 
+            set_folder_index_status(fp, uid, meta_obj['status'])
+
         return meta_obj
 
-    @app.route("/<path:folder>/<int:uid>/<path>")
+    @app.route("/<path:folder>/<int:uid>/<path>", methods=['GET'])
     def mime_part(folder, uid, path):
         folder = unquote_plus(folder)
 
-        p = email.parser.BytesParser()
-        fp = os.path.join(args.directory, folder_name_path(folder), str(uid), 'rfc822')
-        with open(fp, 'rb') as f:
-            m = p.parse(f)
-
-        parts = get_attachment_parts_and_paths(m)
-        p = parts[path]
+        up = os.path.join(folder_dir(folder), str(uid))
+        parts_path = os.path.join(up, 'parts')
 
-        resp = make_response(p.get_payload(decode=True), 200)
+        index_path = os.path.join(parts_path, 'index.json')
+        if os.path.exists(index_path):
+            parts = read_metafile(index_path)
+            if path not in parts:
+                abort(404)
 
-        resp.headers['Content-Type'] = p.get_content_type()
+            resp = send_from_directory(
+                parts_path, path, mimetype=parts[path]['content_type'])
+            filename = parts[path]['filename']
+        else:
+            # Not extracted at fetch time. Stream the part straight out of the
+            # message, decoding as we go.
+            fp = os.path.join(up, 'rfc822')
+            try:
+                p, start, end = scan_message_cached(fp)[path]
+            except KeyError:
+                abort(404)
+
+            resp = Response(iter_part_payload(fp, p, start, end), 200)
+            resp.headers['Content-Type'] = p.get_content_type()
+            filename = p.get_filename()
+
+        # A message never changes once fetched
+        resp.headers['Cache-Control'] = 'public, max-age=3600'
         if request.args.get('disposition') == 'attachment':
             resp.headers['Content-Disposition'] = 'attachment'
 
-            if p.get_filename():
-                resp.headers['Content-Disposition'] += f'; filename="{p.get_filename()}"'
+            if filename:
+                resp.headers['Content-Disposition'] += f'; filename="{filename}"'
 
         return resp
 
-    app.run(debug=True)
+    # The debugger and reloader are handy during development, but the
+    # default is a multi-threaded server so that one browser loading a large
+    # attachment doesn't stall everything else
+    if args.debug:
+        app.run(debug=True)
+    else:
+        run_simple('127.0.0.1', 5000, app, threaded=True)
+
+
+def strip_message(message_path, stripped_path):
+    '''
+    Write the message at message_path with all of its attachments removed to
+    stripped_path, with CRLF line endings as IMAP wants, and return its date,
+    or None if it doesn't have a usable one.
+
+    This runs in a worker process.
+    '''
+
+    bp = email.parser.BytesParser(policy=email.policy.default)
+    with open(message_path, 'rb') as f:
+        m = bp.parse(f)
+
+    # By default, the APPEND command will mark the message's timestamp with
+    # the current time. Instead, grab the date from the message itself, if we
+    # can make sense of it.
+    try:
+        dt = datetime.strptime(m.get('Date'), '%a, %d %b %Y %H:%M:%S %z')
+    except (TypeError, ValueError):
+        logging.warning(f'Unable to parse Date of {message_path}; using the current time')
+        dt = None
+
+    for _, p in walk_attachments(m):
+        # Estimate the size from the encoded payload rather than decoding the
+        # whole thing just to log it
+        size = len(p.get_payload())
+        if p.get('Content-Transfer-Encoding', '').strip().lower() == 'base64':
+            size = size * 3 // 4
+
+        logging.debug(f'Clearing ~{size} byte attachment')
+        p.clear_content()
+
+    with open(stripped_path, 'wb') as f:
+        bg = email.generator.BytesGenerator(f)
+        bg.flatten(m, linesep='\r\n')
+
+    return dt
+
+
+def imap_append_file(ic, mailbox, flags, date_time, fp):
+    '''
+    Like IMAP4.append(), but send the message from the file at the given path,
+    which must already have CRLF line endings.
+
+    imaplib only needs the literal to have a length and to be writable to the
+    socket, so hand it a read-only mapping of the file rather than reading
+    the whole thing into memory.
+    '''
+
+    with open(fp, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        ic.literal = mm
+        return ic._simple_command(
+            'APPEND', mailbox, flags,
+            imaplib.Time2Internaldate(date_time) if date_time else None)
 
 
 def push(args):
@@ -432,66 +1951,56 @@ def push(args):
         pw = getpass.getpass(prompt=f'Password for {args.user}: ')
 
     # TODO: Keep flags the same
-    with imaplib.IMAP4_SSL(host=args.server) as ic:
-        if args.verbosity > 2:
-            ic.debug = args.verbosity - 2
-
-        ic.login(args.user, pw)
+    with ProcessPoolExecutor() as executor, imap_connect(args, pw) as ic:
 
         # Walk list of server folders
-        typ, list_lines = ic.list()
-        assert typ == 'OK'
-        for list_line in map(lambda l: l.decode('utf-8'), list_lines):
-            m = re.match(r'^\((?P<attrs>(\\[a-zA-Z]+\s?)*)\)\s+"(?P<delim>[^"]+)"\s+"(?P<name>[^"]+)"$', list_line)
-            if not m:
-                logging.warning(f'skipping LIST response {f}')
-                continue
-
-            gd = m.groupdict()
-
-            folder_name = gd['name']
-            folder_attrs = set(re.split(r'\s+', gd['attrs']))
-
-            # Can't select this folder for some reason. Specified by the RFC.
-            if r'\Noselect' in folder_attrs:
-                continue
+        for folder_name in imap_list_folders(ic):
+            decoded_name = decode_folder_name(folder_name)
 
             # The user has asked to run on a single folder; skip
-            if args.f and folder_name != args.f:
+            if args.f and args.f not in (decoded_name, folder_name):
                 continue
 
-            logging.info(f'Beginning push for folder {folder_name}')
+            logging.info(f'Beginning push for folder {decoded_name}')
 
             # Manually quote the folder name. The imaplib cllient doesn't do
             # this by itself, for some reason. Whatever.
-            typ, _ = ic.select(f'"{folder_name}"')
-            assert typ =='OK'
-
-            folder_path = os.path.join(args.directory, folder_name_path(folder_name))
+            imap_ok(*ic.select(f'"{folder_name}"'))
 
-            # Process UIDs in order so that it's easier to understand the logs
-            for uid in sorted([
-                    int(fn) for fn in os.listdir(folder_path)
-                        if re.match(r'^\d+$', fn)]):
-                fp = os.path.join(folder_path, str(uid))
-                if not os.path.isdir(fp):
-                    continue
+            folder_path = os.path.join(args.directory, folder_name_path(decoded_name))
 
+            # Find the messages that we need to look at
+            todo = []
+            for uid in list_uids(folder_path):
                 # The user has asked to run on a single UID; skip
                 if args.u and args.u != uid:
                     continue
 
-                meta_obj = read_metafile(os.path.join(fp, 'meta.json'))
+                meta_obj = read_metafile(os.path.join(folder_path, str(uid), 'meta.json'))
                 status = meta_obj.get('status')
 
+                if status is not None:
+                    todo.append((uid, status, meta_obj))
+
+            # Stripping messages is CPU-bound, so kick that off for all of
+            # them up front on a pool of worker processes.
+            stripped = {
+                uid: executor.submit(
+                    strip_message,
+                    os.path.join(folder_path, str(uid), 'rfc822'),
+                    os.path.join(folder_path, str(uid), 'stripped'))
+                for uid, status, _ in todo
+                    if status in ['delete', 'download']}
+
+            # Process UIDs in order so that it's easier to understand the logs
+            for uid, status, meta_obj in todo:
                 # Check if the message still exists
                 #
                 # Only do this if we have a real status, as this is expensive to
                 # do and makes iteration slower if we weren't going to do
                 # anything anyway.
-                if status is not None and not args.dry_run:
-                    typ, data = ic.uid('fetch', str(uid), 'FAST')
-                    assert typ == 'OK'
+                if not args.dry_run:
+                    data = imap_ok(*ic.uid('fetch', str(uid), 'FAST'))
                     if data == [None]:
                         logging.info(f'Skipping UID {uid} which has dissappeared')
                         continue
@@ -499,76 +2008,121 @@ def push(args):
                 if status in ['delete', 'download']:
                     logging.debug(f'Stripping {uid}')
 
+                    # Wait for the stripped copy before touching the server,
+                    # so that a message we can't process is left alone
+                    dt = stripped.pop(uid).result()
+                    stripped_path = os.path.join(folder_path, str(uid), 'stripped')
+
                     # Gmail deletion happens by moving to the special folder
                     # "[Gmail]/Trash". We use the MOVE extension here rather
-                    # than COPY and appending the \Deleted flag.
-                    if not args.dry_run:
-                        ic.uid('move', str(uid), '[Gmail]/Trash')
-
-                    message_path = os.path.join(folder_path, str(uid), 'rfc822')
-                    bp = email.parser.BytesParser(policy=email.policy.default)
-                    with open(message_path, 'rb') as f:
-                        m = bp.parse(f)
-
-                    # By default, the APPEND command will mark the message's
-                    # timestamp with the current time. Instead, grab the date
-                    # from the message itself.
-                    dt = datetime.strptime(m.get('Date'), '%a, %d %b %Y %H:%M:%S %z')
-                    assert dt
-
-                    for p in get_attachment_parts_and_paths(m).values():
-                        logging.debug(f'Clearing {len(p.get_payload(decode=True))} byte attachment')
-                        p.clear_content()
+                    # than COPY and appending the \Deleted flag. Then put back the stripped copy.
+                    try:
+                        if not args.dry_run:
+                            imap_ok(*ic.uid('move', str(uid), '[Gmail]/Trash'))
+                            imap_ok(*imap_append_file(
+                                ic, f'"{folder_name}"', r'(\Seen)', dt,
+                                stripped_path))
+                    finally:
+                        os.unlink(stripped_path)
+
+                    # With UIDPLUS the server tells us the UID of the
+                    # stripped copy, so record it without re-listing
+                    if has_cap(ic, 'UIDPLUS'):
+                        _, appenduid = ic.response('APPENDUID')
+                        if appenduid and appenduid[0]:
+                            new_uid = int(appenduid[0].split()[-1])
+                            logging.debug(f'Stripped copy of {uid} is UID {new_uid}')
+
+                            meta_obj['APPENDUID'] = new_uid
+                            write_metafile(
+                                os.path.join(folder_path, str(uid), 'meta.json'),
+                                meta_obj)
+
+            # Clean up after messages that we skipped
+            for uid, future in stripped.items():
+                future.result()
+                os.unlink(os.path.join(folder_path, str(uid), 'stripped'))
+
+
+def copy_message(uid_path, copydir):
+    '''
+    Save each attachment of the message in the given directory to copydir,
+    renaming as needed to avoid clobbering existing files.
 
-                    dataf = io.BytesIO()
-                    bg = email.generator.BytesGenerator(dataf)
-                    bg.flatten(m)
+    This runs in a worker process.
+    '''
 
-                    if not args.dry_run:
-                        ic.append(f'"{folder_name}"', r'(\Seen)', dt, dataf.getvalue())
+    # Only the attachments are needed, so find them by scanning rather than
+    # parsing the whole message
+    message_path = os.path.join(uid_path, 'rfc822')
+    for path, (p, start, end) in scan_message(message_path).items():
+        # Attachments can be marked as such without a filename. Make one up
+        # rather than losing them when the message is later stripped. Either
+        # way, never write outside of copydir.
+        filename = os.path.basename(p.get_filename() or '')
+        if not filename:
+            ext = mimetypes.guess_extension(p.get_content_type()) or ''
+            filename = f'{os.path.basename(uid_path)}-{path}{ext}'
+            logging.warning(
+                f'Attachment {path} of {uid_path} has no filename; saving it '
+                f'as {filename}')
+
+        # Other workers are saving files at the same time, so claim the name
+        # by creating the file exclusively rather than checking first.
+        fn = filename
+        base, ext = os.path.splitext(filename)
+        o = 1
+        while True:
+            fp = os.path.join(copydir, fn)
+            try:
+                of = open(fp, 'xb')
+                break
+            except FileExistsError:
+                pass
+
+            fn = f'{base}({o}){ext}'
+            o += 1
+
+        logging.debug(f'Saving {filename} => {fp}')
+        with of:
+            for chunk in iter_part_payload(message_path, p, start, end):
+                of.write(chunk)
 
 
 def copy(args):
-    for folder_name in os.listdir(args.directory):
-        folder_path = os.path.join(args.directory, folder_name)
-
-        if not os.path.isdir(folder_path):
-            continue
-
-        for uid in os.listdir(folder_path):
-            uid_path = os.path.join(folder_path, uid)
+    uid_paths = []
+    with os.scandir(args.directory) as it:
+        folder_paths = [de.path for de in it if de.is_dir(follow_symlinks=False)]
 
-            if not os.path.isdir(uid_path):
-                continue
+    for folder_path in folder_paths:
+        for uid in list_uids(folder_path):
+            uid_path = os.path.join(folder_path, str(uid))
 
             meta_obj = read_metafile(os.path.join(uid_path, 'meta.json'))
             if meta_obj.get('status') != 'download':
                 continue
 
-            logging.info(f'Copying {folder_name}/{uid}')
+            uid_paths.append(uid_path)
 
-            message_path = os.path.join(uid_path, 'rfc822')
-            bp = email.parser.BytesParser(policy=email.policy.default)
-            with open(message_path, 'rb') as f:
-                m = bp.parse(f)
+    # Each message is independent, so parse and save them in parallel
+    with ProcessPoolExecutor() as executor:
+        futures = [
+            executor.submit(copy_message, uid_path, args.copydir)
+                for uid_path in uid_paths]
 
-            for p in get_attachment_parts_and_paths(m).values():
-                fn = p.get_filename()
-                assert fn
+        for uid_path, future in zip(uid_paths, futures):
+            logging.info(f'Copying {os.path.relpath(uid_path, args.directory)}')
+            future.result()
 
-                o = 1
-                while True:
-                    fp = os.path.join(args.copydir, fn)
-                    if not os.path.exists(fp):
-                        break
 
-                    base, ext = os.path.splitext(p.get_filename())
-                    fn = f'{base}({o}){ext}'
-                    o += 1
+def reindex(args):
+    with os.scandir(args.directory) as it:
+        folder_paths = sorted(
+            de.path for de in it if de.is_dir(follow_symlinks=False))
 
-                logging.debug(f'Saving {p.get_filename()} => {fp}')
-                with open(fp, 'wb') as of:
-                    of.write(p.get_payload(decode=True))
+    for folder_path in folder_paths:
+        logging.info(f'Reindexing {os.path.relpath(folder_path, args.directory)}')
+        update_folder_index(folder_path, rebuild=True)
 
 
 def main():
@@ -589,6 +2143,17 @@ messages.
     fetch_ap.add_argument('copydir', help='directory to place copied files in')
 
     fetch_ap = sp.add_parser('fetch', help='fetch mail')
+    fetch_ap.add_argument(
+        '--pipeline', type=int, default=FETCH_BATCH_SIZE,
+        help='number of messages to request from the server at once; '
+            f'default {FETCH_BATCH_SIZE}')
+    fetch_ap.add_argument(
+        '--daemon', action='store_true', default=False,
+        help='keep running, fetching again whenever new mail arrives')
+    fetch_ap.add_argument(
+        '-j', '--jobs', type=int, default=FETCH_JOBS,
+        help='number of folders to fetch at once, each over its own '
+            f'connection; default {FETCH_JOBS}')
     fetch_ap.add_argument(
         '-p', help='read the user password from the given file')
     fetch_ap.add_argument(
@@ -611,7 +2176,14 @@ messages.
     push_ap.add_argument(
         'server', help='mail server to login to')
 
+    sp.add_parser(
+        'reindex', help='rebuild folder indexes from message metadata')
+
     web_ap = sp.add_parser('web', help='run webserver')
+    web_ap.add_argument(
+        '--debug', action='store_true', default=False,
+        help='run the single-threaded development server with the debugger '
+            'and reloader')
 
     args = ap.parse_args()
 
@@ -625,5 +2197,11 @@ messages.
         fetch(args)
     elif args.subcommand == 'push':
         push(args)
+    elif args.subcommand == 'reindex':
+        reindex(args)
     elif args.subcommand == 'web':
         web(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,17 @@
+import base64
+import binascii
+import email.message
 import email.parser
 import os.path
+import quopri
 
+from harvest.main import a2b_base64_lenient
+from harvest.main import copy_message
+from harvest.main import decode_payload
 from harvest.main import get_attachment_parts_and_paths
+from harvest.main import iter_part_payload
 from harvest.main import part_is_inline_image
+from harvest.main import scan_attachments
 
 def test_top_level_attachment():
     '''
@@ -61,3 +70,149 @@ def test_inline_image_bad_mime_type():
     assert set(ap.keys()) == {str(n) for n in range(2, 23)}
     for p in ap.values():
         assert part_is_inline_image(p)
+
+
+def test_nested_attachment_paths():
+    '''
+    Verify that attachments in nested multiparts are keyed by their dotted
+    MIME path, in document order.
+    '''
+
+    m = email.message.EmailMessage()
+    m.set_content('body')
+
+    inner = email.message.EmailMessage()
+    inner.set_content('inner body')
+    inner.add_attachment(b'a', maintype='application', subtype='octet-stream', filename='a.bin')
+    inner.add_attachment(b'b', maintype='application', subtype='octet-stream', filename='b.bin')
+
+    m.add_attachment(b'c', maintype='application', subtype='octet-stream', filename='c.bin')
+    m.attach(inner)
+
+    ap = get_attachment_parts_and_paths(m)
+    assert list(ap.keys()) == ['2', '3.2', '3.3']
+    assert [p.get_filename() for p in ap.values()] == ['c.bin', 'a.bin', 'b.bin']
+
+
+def test_bad_base64_padding():
+    '''
+    Verify that base64 payloads with missing or stray padding are decoded
+    as far as possible rather than raising.
+    '''
+
+    assert a2b_base64_lenient(b'QUJDRA==') == b'ABCD'
+    assert a2b_base64_lenient(b'QUJDRA') == b'ABCD'
+    assert a2b_base64_lenient(b'QUJDRA=') == b'ABCD'
+    assert a2b_base64_lenient(b'QUJDREVGR') == b'ABCDEF'
+
+    payload = decode_payload('base64', [b'QUJD\r\nREV', b'GRw\r\n'])
+    assert b''.join(payload) == b'ABCDEFG'
+
+
+def test_decode_payload():
+    '''
+    Verify that each Content-Transfer-Encoding is decoded correctly, wherever
+    the chunks are split.
+    '''
+
+    data = os.urandom(3000)
+    uu = b'begin 644 a.bin\r\n' + b''.join(
+        binascii.b2a_uu(data[i:i + 45]).replace(b'\n', b'\r\n')
+            for i in range(0, len(data), 45)) + b'`\r\nend\r\n'
+
+    for cte, encoded in [
+            ('base64', base64.encodebytes(data)),
+            ('quoted-printable', quopri.encodestring(data)),
+            ('x-uuencode', uu),
+            ('8bit', data)]:
+        for size in (7, 100, len(encoded)):
+            chunks = [encoded[i:i + size] for i in range(0, len(encoded), size)]
+            assert b''.join(decode_payload(cte, chunks)) == data
+
+
+def test_scan_attachments():
+    '''
+    Verify that scanning the raw message finds the same attachments, with the
+    same decoded payloads, as walking a full parse.
+    '''
+
+    for fn in os.listdir(os.path.join(os.path.dirname(__file__), 'data')):
+        mbox_path = os.path.join(os.path.dirname(__file__), 'data', fn)
+
+        bp = email.parser.BytesParser()
+        with open(mbox_path, 'rb') as f:
+            m = bp.parse(f)
+
+        with open(mbox_path, 'rb') as f:
+            sa = scan_attachments(f.read())
+
+        ap = get_attachment_parts_and_paths(m)
+        assert list(sa.keys()) == list(ap.keys())
+
+        for path, (p, start, end) in sa.items():
+            assert p.get_filename() == ap[path].get_filename()
+            assert p.get_content_type() == ap[path].get_content_type()
+
+            payload = b''.join(iter_part_payload(mbox_path, p, start, end))
+            assert payload == ap[path].get_payload(decode=True)
+
+
+def test_scan_nested_attachments(monkeypatch, tmp_path):
+    '''
+    Verify that scanning finds attachments in nested multiparts and decodes
+    them across chunk boundaries.
+    '''
+
+    import harvest.main
+
+    m = email.message.EmailMessage()
+    m.set_content('body')
+
+    inner = email.message.EmailMessage()
+    inner.set_content('inner body')
+    inner.add_attachment(os.urandom(5000), maintype='application', subtype='octet-stream', filename='a.bin')
+    inner.add_attachment(b'b' * 100, maintype='text', subtype='plain', filename='b.txt')
+
+    m.add_attachment(b'c', maintype='application', subtype='octet-stream', filename='c.bin')
+    m.attach(inner)
+
+    mbox_path = tmp_path / 'rfc822'
+    mbox_path.write_bytes(m.as_bytes())
+
+    sa = scan_attachments(mbox_path.read_bytes())
+    assert list(sa.keys()) == ['2', '3.2', '3.3']
+
+    monkeypatch.setattr(harvest.main, 'PAYLOAD_CHUNK_SIZE', 1000)
+    for path, p in get_attachment_parts_and_paths(m).items():
+        payload = b''.join(iter_part_payload(mbox_path, *sa[path]))
+        assert payload == p.get_payload(decode=True)
+
+
+def test_copy_message(tmp_path):
+    '''
+    Verify that attachments are copied out under their own names, that
+    existing files aren't clobbered, and that attachments without a usable
+    filename are still saved.
+    '''
+
+    m = email.message.EmailMessage()
+    m.set_content('body')
+    m.add_attachment(b'a', maintype='application', subtype='octet-stream', filename='a.bin')
+    m.add_attachment(b'b', maintype='application', subtype='pdf', disposition='attachment')
+    m.add_attachment(b'c', maintype='application', subtype='octet-stream', filename='../c.bin')
+
+    uid_path = tmp_path / '12'
+    uid_path.mkdir()
+    (uid_path / 'rfc822').write_bytes(m.as_bytes())
+
+    copydir = tmp_path / 'copy'
+    copydir.mkdir()
+    (copydir / 'a.bin').write_bytes(b'existing')
+
+    copy_message(str(uid_path), str(copydir))
+
+    assert sorted(os.listdir(copydir)) == ['12-3.pdf', 'a(1).bin', 'a.bin', 'c.bin']
+    assert (copydir / 'a.bin').read_bytes() == b'existing'
+    assert (copydir / 'a(1).bin').read_bytes() == b'a'
+    assert (copydir / '12-3.pdf').read_bytes() == b'b'
+    assert (copydir / 'c.bin').read_bytes() == b'c'
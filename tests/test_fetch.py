@@ -0,0 +1,287 @@
+import os.path
+import pytest
+import queue
+import threading
+import zlib
+
+from harvest.main import CompressingIMAP4_SSL
+from harvest.main import decode_folder_name
+from harvest.main import folder_index_locked
+from harvest.main import imap_idle
+from harvest.main import imap_list_folders
+from harvest.main import imap_ok
+from harvest.main import imap_uid_set
+from harvest.main import IMAPError
+from harvest.main import MetaWriter
+from harvest.main import parse_fetch_response
+from harvest.main import parse_fetch_sizes
+from harvest.main import parse_uid_set
+from harvest.main import read_metafile
+from harvest.main import recover_journal
+from harvest.main import set_folder_index_status
+from harvest.main import update_folder_index
+from harvest.main import write_messages
+
+def test_imap_uid_set():
+    '''
+    Verify that contiguous UIDs are collapsed into ranges.
+    '''
+
+    assert imap_uid_set([5]) == '5'
+    assert imap_uid_set([1, 2, 3, 7, 9, 10]) == '1:3,7,9:10'
+
+
+def test_decode_folder_name():
+    '''
+    Verify that modified UTF-7 folder names are decoded, and that plain ASCII
+    ones are left alone.
+    '''
+
+    assert decode_folder_name('[Gmail]/Sent Mail') == '[Gmail]/Sent Mail'
+    assert decode_folder_name('[Gmail]/&BBoEPgRABDcEOAQ9BDA-') == '[Gmail]/Корзина'
+    assert decode_folder_name('R&AOk-sum&AOk- &- CV') == 'Résumé & CV'
+
+
+def test_imap_list_folders():
+    '''
+    Verify that folders that can't be selected and LIST responses that we
+    don't understand are skipped.
+    '''
+
+    class FakeIMAP:
+        def list(self):
+            return 'OK', [
+                b'(\\HasNoChildren) "/" "INBOX"',
+                b'(\\HasChildren \\Noselect) "/" "[Gmail]"',
+                b'(\\HasNoChildren \\Trash) "/" "[Gmail]/&BBoEPgRABDcEOAQ9BDA-"',
+                (b'(\\HasNoChildren) "/" {3}', b'odd'),
+            ]
+
+    assert list(imap_list_folders(FakeIMAP())) == [
+        'INBOX', '[Gmail]/&BBoEPgRABDcEOAQ9BDA-']
+
+
+
+def test_imap_idle():
+    '''
+    Verify that changes reported before the server agrees to idle, or
+    received along with its agreement, are noticed without waiting.
+    '''
+
+    for responses in [
+            b'* 5 EXISTS\r\n+ idling\r\nA1 OK done\r\n',
+            b'+ idling\r\n* 5 EXISTS\r\nA1 OK done\r\n']:
+        ic = CompressingIMAP4_SSL.__new__(CompressingIMAP4_SSL)
+        ic._rbuf = bytearray()
+        ic.sock = FakeSocket([responses])
+        ic.tagpre = b'A'
+        ic.tagnum = 1
+        ic.tagged_commands = {}
+        ic._encoding = 'ascii'
+
+        assert imap_idle(ic, 3600)
+        assert ic.sock.sent == b'A1 IDLE\r\nDONE\r\n'
+
+    ic.sock = FakeSocket([b'A2 BAD no\r\n'])
+    with pytest.raises(IMAPError):
+        imap_idle(ic, 3600)
+
+def test_parse_uid_set():
+    '''
+    Verify that sequence sets are expanded to every UID they cover, whichever
+    way round ranges are written.
+    '''
+
+    assert list(parse_uid_set(b'1:3,7,10:9')) == [1, 2, 3, 7, 9, 10]
+    assert list(parse_uid_set(imap_uid_set([4, 5, 6, 8]).encode())) == [4, 5, 6, 8]
+
+
+def test_parse_fetch_response():
+    '''
+    Verify that message bodies are matched up with their UIDs, wherever the
+    server puts the UID in the response.
+    '''
+
+    data = [
+        (b'1 (UID 10 RFC822 {3}', b'abc'),
+        b')',
+        (b'2 (RFC822 {3}', b'def'),
+        b' UID 12)',
+        None,
+    ]
+
+    assert list(parse_fetch_response(data)) == [(10, b'abc'), (12, b'def')]
+
+
+
+def test_parse_fetch_sizes():
+    '''
+    Verify that message sizes are matched up with their UIDs, whichever order
+    the server sends them in.
+    '''
+
+    data = [b'1 (UID 10 RFC822.SIZE 2000000)', b'2 (RFC822.SIZE 5 UID 12)', None]
+
+    assert list(parse_fetch_sizes(data)) == [(10, 2000000), (12, 5)]
+
+
+def test_write_messages(tmp_path):
+    '''
+    Verify that messages arriving a chunk at a time are only written out under
+    their real names once complete, and that UIDFETCHNEXT never passes a
+    message that is still being written.
+    '''
+
+    fp = str(tmp_path / 'meta.json')
+    mw = MetaWriter(fp, {}, flush_interval=1)
+
+    messages = queue.Queue()
+    for item in [
+            (10, b'ab', False), (11, b'cd', True), (12, b'ef', False),
+            (10, b'gh', True), (12, None, True), None]:
+        messages.put(item)
+
+    write_messages(str(tmp_path), mw, messages)
+
+    assert (tmp_path / '10' / 'rfc822').read_bytes() == b'abgh'
+    assert (tmp_path / '11' / 'rfc822').read_bytes() == b'cd'
+    assert os.listdir(tmp_path / '12') == []
+    assert read_metafile(fp) == {'UIDFETCHNEXT': 12}
+
+
+def test_write_messages_malformed(tmp_path):
+    '''
+    Verify that a message whose attachments can't be extracted is still
+    written, without a parts index, and doesn't stop the fetch.
+    '''
+
+    fp = str(tmp_path / 'meta.json')
+    mw = MetaWriter(fp, {}, flush_interval=1)
+
+    bad = (
+        b'Content-Type: multipart/mixed; boundary="X"\r\n\r\n--X\r\n'
+        b'Content-Disposition: attachment; filename="a"\r\n'
+        b'Content-Transfer-Encoding: x-uuencode\r\n\r\n'
+        b'begin 644 a\r\nM\x00\xff garbage\r\nend\r\n--X--\r\n')
+
+    messages = queue.Queue()
+    for item in [(10, bad, True), (11, b'Subject: ok\r\n\r\nhi\r\n', True), None]:
+        messages.put(item)
+
+    write_messages(str(tmp_path), mw, messages)
+
+    assert (tmp_path / '10' / 'rfc822').read_bytes() == bad
+    assert not (tmp_path / '10' / 'parts' / 'index.json').exists()
+    assert (tmp_path / '11' / 'parts' / 'index.json').exists()
+    assert read_metafile(fp) == {'UIDFETCHNEXT': 12}
+
+def test_meta_writer_journal(tmp_path):
+    '''
+    Verify that journalled updates made since the last flush are recovered
+    after an interruption, and that flushing clears the journal.
+    '''
+
+    fp = str(tmp_path / 'meta.json')
+
+    mw = MetaWriter(fp, {'UIDFETCHNEXT': 1}, flush_interval=3, journal_key='UIDFETCHNEXT')
+    for uid in range(10, 15):
+        mw.update('UIDFETCHNEXT', uid + 1)
+
+    # Interrupted after a flush at 13 with two more updates journalled
+    obj = read_metafile(fp)
+    assert obj == {'UIDFETCHNEXT': 13}
+    recover_journal(fp, obj, 'UIDFETCHNEXT')
+    assert obj == {'UIDFETCHNEXT': 15}
+
+    mw.flush()
+    assert read_metafile(fp) == {'UIDFETCHNEXT': 15}
+    assert not os.path.exists(fp + '.journal')
+
+
+def test_imap_ok():
+    '''
+    Verify that failed IMAP commands raise rather than returning their data.
+    '''
+
+    assert imap_ok('OK', [b'1 2']) == [b'1 2']
+
+    with pytest.raises(IMAPError):
+        imap_ok('NO', [b'no such folder'])
+
+
+class FakeSocket:
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.sent = b''
+
+    def recv(self, size):
+        return self.chunks.pop(0) if self.chunks else b''
+
+    def sendall(self, data):
+        self.sent += bytes(data)
+
+
+def test_compressing_imap():
+    '''
+    Verify that data is decompressed on the way in and compressed on the way
+    out once COMPRESS=DEFLATE is in effect, however the server's data is split
+    up.
+    '''
+
+    comp = zlib.compressobj(-1, zlib.DEFLATED, -15)
+    data = comp.compress(b'* 1 FETCH (RFC822 {5}\r\nhello)\r\nA1 OK done\r\n')
+    data += comp.flush(zlib.Z_SYNC_FLUSH)
+
+    ic = CompressingIMAP4_SSL.__new__(CompressingIMAP4_SSL)
+    ic._rbuf = bytearray()
+    ic.sock = FakeSocket(data[i:i + 3] for i in range(0, len(data), 3))
+    ic._simple_command = lambda *args: ('OK', [b'compressing'])
+    ic.compress()
+
+    assert not ic.pending()
+    assert ic.readline() == b'* 1 FETCH (RFC822 {5}\r\n'
+    assert ic.read(5) == b'hello'
+    assert ic.readline() == b')\r\n'
+    assert ic.readline() == b'A1 OK done\r\n'
+    assert not ic.pending()
+    assert ic.readline() == b''
+
+    # Lines that arrived together are pending once the first has been read
+    ic.sock.chunks = [data]
+    ic._decompressor = zlib.decompressobj(-15)
+    ic.readline()
+    assert ic.pending()
+
+    ic.send(b'A2 NOOP\r\n')
+    ic.send(b'x' * 3000000)
+    assert zlib.decompressobj(-15).decompress(ic.sock.sent) == \
+        b'A2 NOOP\r\n' + b'x' * 3000000
+
+
+def test_folder_index_lock(tmp_path):
+    '''
+    Verify that updating the folder index after a fetch waits for a status
+    change that is in progress, rather than writing back a stale index over
+    it.
+    '''
+
+    for uid in (1, 2):
+        (tmp_path / str(uid)).mkdir()
+
+    assert update_folder_index(str(tmp_path)) == {'1': None, '2': None}
+    (tmp_path / '3').mkdir()
+
+    with folder_index_locked(str(tmp_path)):
+        fetcher = threading.Thread(target=update_folder_index, args=(str(tmp_path),))
+        fetcher.start()
+        fetcher.join(0.2)
+        assert fetcher.is_alive()
+
+        (tmp_path / '1' / 'meta.json').write_text('{"status": "keep"}')
+        (tmp_path / 'index.json').write_text('{"1": "keep", "2": null}')
+
+    fetcher.join()
+    assert read_metafile(str(tmp_path / 'index.json')) == {'1': 'keep', '2': None, '3': None}
+
+    set_folder_index_status(str(tmp_path), 2, 'delete')
+    assert read_metafile(str(tmp_path / 'index.json')) == {'1': 'keep', '2': 'delete', '3': None}
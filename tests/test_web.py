@@ -0,0 +1,131 @@
+import argparse
+import email.message
+import json
+import pytest
+
+import harvest.main
+from harvest.main import extract_parts
+from harvest.main import web
+
+
+@pytest.fixture
+def store(tmp_path):
+    '''
+    A mail store with one folder holding three messages: one with extracted
+    attachments, one with no attachments, and one fetched before attachments
+    were extracted.
+    '''
+
+    folder_path = tmp_path / 'INBOX'
+    folder_path.mkdir()
+    (folder_path / 'meta.json').write_text(json.dumps({'NAME': 'INBOX'}))
+
+    for uid in (10, 12, 15):
+        m = email.message.EmailMessage()
+        m['Subject'] = f'message {uid}'
+        m.set_content('body')
+        if uid != 12:
+            m.add_attachment(b'attached', maintype='application', subtype='octet-stream', filename='a.bin')
+
+        msg_dir_path = folder_path / str(uid)
+        msg_dir_path.mkdir()
+        (msg_dir_path / 'rfc822').write_bytes(m.as_bytes())
+        if uid != 15:
+            extract_parts(str(msg_dir_path))
+
+    (folder_path / '10' / 'meta.json').write_text(json.dumps({'status': 'keep'}))
+
+    return tmp_path
+
+
+@pytest.fixture
+def client(store, monkeypatch):
+    apps = []
+    monkeypatch.setattr(harvest.main, 'run_simple', lambda *args, **kwargs: apps.append(args[2]))
+
+    web(argparse.Namespace(directory=str(store), debug=False))
+
+    return apps[0].test_client()
+
+
+def test_folders(client):
+    '''
+    Verify that the folder list and folder pages show what is in the store,
+    and that folder names can't escape it.
+    '''
+
+    assert 'INBOX' in client.get('/').get_data(as_text=True)
+
+    page = client.get('/INBOX/').get_data(as_text=True)
+    assert 'href="/INBOX/10" class="keep"' in page
+    assert 'href="/INBOX/12" class="unknown"' in page
+
+    assert client.get('/%2E%2E/').status_code == 404
+    assert client.get('/%2E%2E/INBOX/10/summary').status_code == 404
+
+
+def test_uid(client):
+    '''
+    Verify that message pages link to their neighbours, and that UIDs that
+    aren't in the folder are not found.
+    '''
+
+    page = client.get('/INBOX/12').get_data(as_text=True)
+    assert '<a href="/INBOX/10">Prev</a>' in page
+    assert '<a href="/INBOX/15">Next</a>' in page
+
+    assert client.get('/INBOX/11').status_code == 404
+    assert client.get('/INBOX/16').status_code == 404
+    assert client.get('/INBOX/11/summary').status_code == 404
+    assert client.get('/INBOX/11/attachments').status_code == 404
+
+    assert client.get('/INBOX/10/summary').get_json()['subject'] == 'message 10'
+
+
+def test_status(client, store):
+    '''
+    Verify that setting a message's status updates both its metadata and the
+    folder index.
+    '''
+
+    resp = client.put('/INBOX/12/status', json={'status': 'delete'})
+    assert resp.get_json() == {'status': 'delete'}
+
+    meta = json.loads((store / 'INBOX' / '12' / 'meta.json').read_text())
+    assert meta == {'status': 'delete'}
+
+    index = json.loads((store / 'INBOX' / 'index.json').read_text())
+    assert index == {'10': 'keep', '12': 'delete', '15': None}
+
+    assert client.put('/INBOX/11/status', json={'status': 'keep'}).status_code == 404
+
+
+def test_attachments(client, monkeypatch):
+    '''
+    Verify that attachments are listed and served from the parts index where
+    there is one, even an empty one, and found by scanning the message
+    otherwise.
+    '''
+
+    scanned = []
+    scan_message_cached = harvest.main.scan_message_cached
+    monkeypatch.setattr(
+        harvest.main, 'scan_message_cached',
+        lambda fp: scanned.append(fp) or scan_message_cached(fp))
+
+    expected = [{'path': '2', 'filename': 'a.bin', 'inline_image': False}]
+    assert client.get('/INBOX/10/attachments').get_json()['attachments'] == expected
+    assert client.get('/INBOX/12/attachments').get_json()['attachments'] == []
+    assert not scanned
+
+    assert client.get('/INBOX/15/attachments').get_json()['attachments'] == expected
+    assert len(scanned) == 1
+
+    for uid in (10, 15):
+        resp = client.get(f'/INBOX/{uid}/2?disposition=attachment')
+        assert resp.get_data() == b'attached'
+        assert resp.headers['Content-Disposition'] == 'attachment; filename="a.bin"'
+        resp.close()
+
+    assert client.get('/INBOX/10/3').status_code == 404
+    assert client.get('/INBOX/15/3').status_code == 404